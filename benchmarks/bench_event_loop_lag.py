@@ -0,0 +1,56 @@
+"""
+Event loop lag while tokenizing a mix of small and large prompts,
+inline on the loop vs with the awaitable helpers of chatgpt.utils
+
+    python -m benchmarks.bench_event_loop_lag [large_prompts] [small_prompts]
+"""
+import asyncio
+import sys
+import time
+
+from chatgpt.utils import acount_tokens, count_tokens, get_encoder
+
+SMALL = "How do I make a cup of tea? " * 20
+# about 30k tokens
+LARGE = "The quick brown fox jumps over the lazy dog, again and again. " * 2500
+
+
+async def monitor(lags: list, stop: asyncio.Event, interval: float = 0.001) -> None:
+    """Record how late the loop wakes up a sleeping task"""
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+
+async def run(count, large_prompts: int, small_prompts: int) -> list:
+    lags = []
+    stop = asyncio.Event()
+    watcher = asyncio.ensure_future(monitor(lags, stop))
+
+    async def request(text):
+        await count(text)
+        await asyncio.sleep(0)
+
+    prompts = [LARGE] * large_prompts + [SMALL] * small_prompts
+    await asyncio.gather(*[request(text) for text in prompts])
+    stop.set()
+    await watcher
+    return sorted(lags)
+
+
+async def inline(text: str) -> int:
+    return count_tokens(text)
+
+
+def main(large_prompts: int = 20, small_prompts: int = 500) -> None:
+    get_encoder()
+    print(f"{large_prompts} prompts of {count_tokens(LARGE)} tokens, {small_prompts} of {count_tokens(SMALL)} tokens")
+    for name, count in (("inline", inline), ("off-loop", acount_tokens)):
+        lags = asyncio.run(run(count, large_prompts, small_prompts))
+        p99 = lags[int(len(lags) * 0.99) - 1] if lags else 0
+        print(f"  {name:10s} loop lag p99 {p99 * 1000:7.2f} ms  max {lags[-1] * 1000 if lags else 0:7.2f} ms")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
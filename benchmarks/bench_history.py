@@ -0,0 +1,99 @@
+"""
+Memory and prompt construction time of conversation history:
+plain message dicts vs compact `Message` records, and the characters
+tokenized per `Chatbot.ask` as the conversation grows
+
+    python -m benchmarks.bench_history [conversations] [turns]
+"""
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import openai
+
+import chatgpt.chatgpt_api
+from chatgpt import Chatbot
+from chatgpt.conversation_store import Conversation, Message, Prompt
+from chatgpt.utils import count_tokens, get_encoder
+
+
+def make_text(i: int, turn: int) -> str:
+    return "conversation %d turn %d: %s" % (i, turn, "lorem ipsum dolor sit amet " * 8)
+
+
+def history_memory(conversations: int, turns: int, factory) -> int:
+    """Bytes allocated for the history containers, content strings excluded"""
+    texts = [[make_text(i, t) for t in range(turns)] for i in range(conversations)]
+    tracemalloc.start()
+    store = {str(i): [factory("user" if t % 2 == 0 else "system", text) for t, text in enumerate(history)]
+             for i, history in enumerate(texts)}
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del store
+    return size
+
+
+def construct_time(turns: int, repeat: int = 200) -> tuple:
+    """Seconds per prompt: re-encoding every message vs cached token counts"""
+    prompt = Prompt()
+    for t in range(turns // 2):
+        prompt.add_to_history(make_text(0, t), make_text(0, t))
+    dicts = [m.to_dict() for m in prompt.chat_history]
+
+    started = time.perf_counter()
+    for _ in range(repeat):
+        sum(count_tokens(m['content']) for m in dicts)
+    encoded = (time.perf_counter() - started) / repeat
+
+    prompt.construct_prompt_messages("new question")
+    started = time.perf_counter()
+    for _ in range(repeat):
+        prompt.construct_prompt_messages("new question")
+    cached = (time.perf_counter() - started) / repeat
+    return encoded, cached
+
+
+def ask_encoded_chars(turns: int) -> list:
+    """Characters tokenized by each ask of a conversation, upstream stubbed out"""
+    encoder = get_encoder()
+    encode, create = encoder.encode, openai.ChatCompletion.create
+    encoded = []
+
+    def counting_encode(text, *args, **kwargs):
+        encoded.append(len(text))
+        return encode(text, *args, **kwargs)
+
+    encoder.encode = counting_encode
+    openai.ChatCompletion.create = lambda **params: {'id': 'x', 'choices': [{'message': {'content': make_text(0, 0)}}]}
+    try:
+        with tempfile.TemporaryDirectory() as root:
+            chatgpt.chatgpt_api.conversation_store = Conversation(file=root + "/conversation.json")
+            chatbot = Chatbot(api_key="bench")
+            per_ask = []
+            for t in range(turns):
+                encoded.clear()
+                chatbot.ask(make_text(0, t), conversation_id="bench", model="gpt-4")
+                per_ask.append(sum(encoded))
+            return per_ask
+    finally:
+        del encoder.encode
+        openai.ChatCompletion.create = create
+
+
+def main(conversations: int = 100000, turns: int = 10) -> None:
+    as_dict = history_memory(conversations, turns, lambda role, content: {'role': role, 'content': content})
+    as_message = history_memory(conversations, turns, Message)
+    print(f"history of {conversations} conversations x {turns} turns")
+    print(f"  dict     {as_dict / 2 ** 20:8.1f} MiB")
+    print(f"  Message  {as_message / 2 ** 20:8.1f} MiB ({1 - as_message / as_dict:.0%} less)")
+    encoded, cached = construct_time(turns)
+    print(f"prompt construction with {turns} turns")
+    print(f"  re-encode {encoded * 1e6:8.1f} us")
+    print(f"  cached    {cached * 1e6:8.1f} us")
+    print(f"characters tokenized per ask over {turns} turns")
+    print("  " + " ".join(str(chars) for chars in ask_encoded_chars(turns)))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,42 @@
+"""
+Import and startup time of a worker, each step measured in a fresh process
+
+    python -m benchmarks.bench_startup [conversations]
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STEPS = {
+    "import chatgpt": "import chatgpt",
+    "import main": "import main",
+    "load tokenizer": "from chatgpt import preload; preload()",
+    "load conversations": "from chatgpt import conversation_store; conversation_store.start()",
+}
+
+
+def measure(statement: str, cwd: str) -> str:
+    """Time spent on `statement` in a new interpreter"""
+    code = ("import sys, time; sys.path.insert(0, %r); started = time.perf_counter(); %s; "
+            "print(time.perf_counter() - started)" % (ROOT, statement))
+    output = subprocess.run([sys.executable, "-c", code], cwd=cwd, capture_output=True, text=True)
+    if output.returncode != 0:
+        return "failed: " + output.stderr.strip().splitlines()[-1]
+    return "%8.1f ms" % (float(output.stdout.strip().splitlines()[-1]) * 1000)
+
+
+def main(conversations: int = 20000) -> None:
+    with tempfile.TemporaryDirectory() as cwd:
+        history = [{'role': 'user', 'content': 'question ' * 20}, {'role': 'system', 'content': 'answer ' * 40}] * 5
+        with open(os.path.join(cwd, "conversation.json"), "w", encoding="utf-8") as f:
+            json.dump({str(i): history for i in range(conversations)}, f)
+        for name, statement in STEPS.items():
+            print(f"{name:20s} {measure(statement, cwd)}")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,45 @@
+"""
+Incremental add and top-k search time of a vector collection
+
+    python -m benchmarks.bench_vector_search [vectors] [dim]
+
+The default 1M x 1536 collection needs about 6 GB of disk.
+"""
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from chatgpt.vector_store import Collection
+
+
+def main(vectors: int = 1000000, dim: int = 1536, batch: int = 50000, queries: int = 20) -> None:
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as root:
+        collection = Collection(root + "/bench")
+        started = time.perf_counter()
+        for start in range(0, vectors, batch):
+            count = min(batch, vectors - start)
+            collection.add(
+                rng.standard_normal((count, dim), dtype=np.float32),
+                metadatas=[{'shard': i % 10} for i in range(start, start + count)])
+        print(f"add {vectors} x {dim} in batches of {batch}: {time.perf_counter() - started:.1f} s")
+
+        started = time.perf_counter()
+        reopened = Collection(root + "/bench")
+        print(f"open from disk: {time.perf_counter() - started:.2f} s")
+
+        for name, filters in (("no filter", None), ("filter 1/10", {'shard': 3})):
+            reopened.search(rng.standard_normal(dim), filters=filters)
+            timings = []
+            for _ in range(queries):
+                query = rng.standard_normal(dim)
+                started = time.perf_counter()
+                reopened.search(query, top_k=10, filters=filters)
+                timings.append(time.perf_counter() - started)
+            print(f"search top 10, {name:12s} p50 {np.median(timings) * 1000:8.1f} ms  max {max(timings) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -1 +1,19 @@
 from .chatgpt_api import Chatbot, AsyncChatbot
+from .conversation_store import conversation_store
+from .utils import ChatgptAPIException, ContextWindowExceeded, TokenizerUnavailable, get_encoder
+
+
+def preload(download: bool = None) -> None:
+    """
+    Load the tokenizer, e.g. in the parent process before forking workers,
+    `download` to fill the vocab cache
+    """
+    get_encoder(download)
+
+
+def startup() -> None:
+    """
+    Load what a worker needs before serving requests
+    """
+    get_encoder()
+    conversation_store.start()
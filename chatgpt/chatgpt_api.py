@@ -1,13 +1,28 @@
 """
 A simple wrapper for the official ChatGPT API
 """
+import asyncio
 import uuid
-from typing import Dict, List
+from typing import AsyncIterator, Dict, List
 import openai
 
-from config import CHAT_MODEL, OPENAI_API_KEY
-from .utils import ChatgptAPIException, get_max_tokens
+from config import (
+    CHAT_MODEL, OPENAI_API_KEY, UPSTREAM_REQUEST_TIMEOUT, EMBEDDING_BATCH_SIZE, EMBEDDING_BATCH_TOKENS,
+    HEDGE_ENABLED, HEDGE_PERCENTILE, HEDGE_BUDGET, HEDGE_API_KEY, HEDGE_API_BASE, ADMISSION_MAX_CONCURRENCY)
+from .models import get_model
+from .utils import (
+    ChatgptAPIException, ContextWindowExceeded, aget_max_tokens, get_encoder, get_max_tokens, pool_embeddings,
+    split_tokens)
 from .conversation_store import Prompt, conversation_store
+from .hedging import Hedger
+
+# the hedge attempt goes to the alternative key / endpoint when configured
+_hedge_upstream = {k: v for k, v in (('api_key', HEDGE_API_KEY), ('api_base', HEDGE_API_BASE)) if v}
+# a thread for the primary and one for the hedge of every admitted request
+upstream_hedger = Hedger(
+    percentile=HEDGE_PERCENTILE, budget=HEDGE_BUDGET,
+    upstreams=[{}, _hedge_upstream] if _hedge_upstream else None,
+    max_workers=2 * ADMISSION_MAX_CONCURRENCY) if HEDGE_ENABLED else None
 
 
 class Chatbot:
@@ -15,12 +30,17 @@ class Chatbot:
     Official ChatGPT API
     """
 
-    def __init__(self, api_key: str, buffer: int = None) -> None:
+    def __init__(self, api_key: str, buffer: int = None, hedger: Hedger = None) -> None:
         """
         Initialize Chatbot with API key (from https://platform.openai.com/account/api-keys)
+        Args:
+            hedger: hedge slow upstream calls, defaults to the shared one when HEDGE_ENABLED
         """
         openai.api_key = api_key or OPENAI_API_KEY
         self.prompt = Prompt(buffer=buffer)
+        self.hedger = hedger or upstream_hedger
+        # token usage reported by the last upstream call
+        self.usage = None
 
     def _get_completion(
         self,
@@ -29,6 +49,7 @@ class Chatbot:
         model: str = CHAT_MODEL,
         max_tokens: int = 4000,
         stream: bool = False,
+        prompt_tokens: int = None,
     ) -> Dict:
         """Get the completion function
 
@@ -37,20 +58,23 @@ class Chatbot:
             ```[{"role": "system", "content": "You are a helpful assistant."},
                {"role": "user", "content": "Who won the world series in 2020?"}]
             ```
+        prompt_tokens -- tokens of the messages when already counted
         Return: return_description
         """
         # calcuate prompt and completion token length
-        prompt = '\n\n'.join([m['content'] for m in messages])
-        openai.proxy
-        return openai.ChatCompletion.create(
+        params = dict(
             model=model,
             messages=messages,
             temperature=temperature,
-            max_tokens=get_max_tokens(model, prompt, max_tokens),
+            max_tokens=get_max_tokens(model, messages, max_tokens, prompt_tokens),
             stop=["\n\n\n"],
             stream=stream,
-            timeout=60
+            timeout=60,
+            request_timeout=UPSTREAM_REQUEST_TIMEOUT
         )
+        if self.hedger is None or stream:
+            return openai.ChatCompletion.create(**params)
+        return self.hedger.call('chat:' + model, lambda upstream: openai.ChatCompletion.create(**params, **upstream))
 
     def _process_completion(
         self,
@@ -94,13 +118,15 @@ class Chatbot:
             conversation_id = str(uuid.uuid4())
         self.load_conversation(conversation_id)
         completion = self._get_completion(
-            self.prompt.construct_prompt_messages(user_request, base_prompt=base_prompt),
+            self.prompt.construct_prompt_messages(user_request, base_prompt=base_prompt, model=model),
             temperature,
             model,
-            max_tokens
+            max_tokens,
+            prompt_tokens=self.prompt.prompt_tokens
         )
         response_text = self._process_completion(user_request, completion)
         message_id = completion['id']
+        self.usage = completion.get('usage')
         return {'prompt': user_request, 'response': response_text, 'conversationId': conversation_id, 'messageId': message_id, 'model': model}
 
     def make_conversation(self, conversation_id: str) -> None:
@@ -137,12 +163,75 @@ class Chatbot:
         """
         conversation_store.add_conversation(conversation_id, self.prompt.chat_history)
 
-    def text_embedding(self, text: str, model: str = "text-embedding-ada-002"):
-        response = openai.Embedding.create(
-            input=text,
-            model=model)
-        embeddings = response['data'][0]['embedding']
-        return embeddings
+    def _create_embedding(self, inputs, model: str) -> Dict:
+        params = dict(input=inputs, model=model, request_timeout=UPSTREAM_REQUEST_TIMEOUT)
+        if self.hedger is None:
+            return openai.Embedding.create(**params)
+        return self.hedger.call('embedding:' + model, lambda upstream: openai.Embedding.create(**params, **upstream))
+
+    def text_embedding(
+        self,
+        text: str,
+        model: str = "text-embedding-ada-002",
+        chunk_size: int = None,
+        chunk_overlap: int = 0,
+        pool: bool = False
+    ):
+        """
+        Embed a text
+        Args:
+            chunk_size: split the text in chunks of this many tokens, embedded in as few calls as possible
+            chunk_overlap: tokens shared by consecutive chunks
+            pool: with chunk_size, return the token weighted mean of the chunk vectors
+                instead of a list of {'embedding', 'offset', 'tokens'}, offset counted in tokens
+        """
+        if not chunk_size:
+            response = self._create_embedding(text, model)
+            self.usage = response.get('usage')
+            embeddings = response['data'][0]['embedding']
+            return embeddings
+
+        chunk_size = min(chunk_size, get_model(model).context_window)
+        if chunk_overlap >= chunk_size:
+            raise ContextWindowExceeded(
+                f"chunk_overlap of {chunk_overlap} tokens leaves no room in the {chunk_size} tokens chunks of {model}")
+        tokens = get_encoder().encode(text, disallowed_special=())
+        chunks = split_tokens(tokens, chunk_size, chunk_overlap)
+        if not chunks:
+            raise ChatgptAPIException("Cannot embed an empty text")
+        vectors = []
+        self.usage = {'prompt_tokens': 0, 'total_tokens': 0}
+        for batch in _embedding_batches([chunk for _, chunk in chunks]):
+            # the API accepts token arrays, no need to decode the chunks
+            response = self._create_embedding(batch, model)
+            vectors += [item['embedding'] for item in sorted(response['data'], key=lambda item: item['index'])]
+            for key in self.usage:
+                self.usage[key] += response.get('usage', {}).get(key, 0)
+        if pool:
+            return pool_embeddings(vectors, [len(chunk) for _, chunk in chunks])
+        return [
+            {'embedding': vector, 'offset': offset, 'tokens': len(chunk)}
+            for vector, (offset, chunk) in zip(vectors, chunks)]
+
+
+def _embedding_batches(chunks: List[List[int]]):
+    """Group chunks in batches within the per request limits of the embedding API"""
+    batch, batch_tokens = [], 0
+    for chunk in chunks:
+        if batch and (len(batch) >= EMBEDDING_BATCH_SIZE or batch_tokens + len(chunk) > EMBEDDING_BATCH_TOKENS):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(chunk)
+        batch_tokens += len(chunk)
+    if batch:
+        yield batch
+
+
+async def _prepend(first, rest: AsyncIterator):
+    """Yield `first`, then everything from `rest`"""
+    yield first
+    async for item in rest:
+        yield item
 
 
 class AsyncChatbot(Chatbot):
@@ -185,6 +274,7 @@ class AsyncChatbot(Chatbot):
         model: str = CHAT_MODEL,
         max_tokens: int = 4000,
         stream: bool = False,
+        prompt_tokens: int = None,
     ) -> Dict:
         """Get the completion function
 
@@ -193,19 +283,36 @@ class AsyncChatbot(Chatbot):
             ```[{"role": "system", "content": "You are a helpful assistant."},
                {"role": "user", "content": "Who won the world series in 2020?"}]
             ```
+        prompt_tokens -- tokens of the messages when already counted
         Return: return_description
         """
         # calcuate prompt and completion token length
         prompt = '\n\n'.join([m['content'] for m in messages])
-        return await openai.ChatCompletion.acreate(
+        params = dict(
             engine=model,
             prompt=prompt,
             temperature=temperature,
-            max_tokens=get_max_tokens(model, prompt, max_tokens),
+            max_tokens=await aget_max_tokens(model, prompt, max_tokens, prompt_tokens),
             stop=["\n\n\n"],
             stream=stream,
-            timeout=60
+            timeout=60,
+            request_timeout=UPSTREAM_REQUEST_TIMEOUT
         )
+        if self.hedger is None:
+            return await openai.ChatCompletion.acreate(**params)
+        if not stream:
+            return await self.hedger.acall('chat:' + model, lambda upstream: openai.ChatCompletion.acreate(**params, **upstream))
+
+        # hedge on the time to first token, then keep streaming from the winner
+        async def first_token(upstream):
+            completion = await openai.ChatCompletion.acreate(**params, **upstream)
+            return await completion.__anext__(), completion
+
+        def discard(result):
+            asyncio.ensure_future(result[1].aclose())
+
+        first, completion = await self.hedger.acall('first_token:' + model, first_token, discard=discard)
+        return _prepend(first, completion)
 
     async def ask(
         self,
@@ -227,7 +334,7 @@ class AsyncChatbot(Chatbot):
             conversation_id = str(uuid.uuid4())
         self.load_conversation(conversation_id)
         completion = self._get_completion(
-            self.prompt.construct_prompt_messages(user_request, base_prompt=base_prompt),
+            self.prompt.construct_prompt_messages(user_request, base_prompt=base_prompt, model=model),
             temperature,
             model,
             max_tokens
@@ -253,11 +360,12 @@ class AsyncChatbot(Chatbot):
             conversation_id = str(uuid.uuid4())
         self.load_conversation(conversation_id)
         completion = await self._get_completion(
-            self.prompt.construct_prompt_messages(user_request, base_prompt=base_prompt),
+            await self.prompt.aconstruct_prompt_messages(user_request, base_prompt=base_prompt, model=model),
             temperature,
             model,
             max_tokens,
-            stream=True
+            stream=True,
+            prompt_tokens=self.prompt.prompt_tokens
         )
         self.conversation_id = conversation_id
         return self._process_completion_stream(
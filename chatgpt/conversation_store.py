@@ -1,11 +1,58 @@
 
 import json
 import os
+import sys
 import threading
 import time
-from typing import List
+from typing import List, Union
 
-from chatgpt.utils import ENCODER
+from config import CHAT_MODEL
+from chatgpt.utils import TOKENS_PER_MESSAGE, TOKENS_PER_REPLY, acount_tokens_batch, count_tokens, get_prompt_budget
+
+
+class Message:
+    """
+    Compact chat history record with an interned role and a cached token count,
+    converted to an OpenAI message dict only when sent to the API
+    """
+    __slots__ = ('role', 'content', '_tokens')
+
+    def __init__(self, role: str, content: str, tokens: int = None) -> None:
+        self.role = sys.intern(role)
+        self.content = content
+        self._tokens = tokens
+
+    @property
+    def tokens(self) -> int:
+        """Tokens of the content, counted once"""
+        if self._tokens is None:
+            self._tokens = count_tokens(self.content)
+        return self._tokens
+
+    def to_dict(self) -> dict:
+        """OpenAI message dict"""
+        return {'role': self.role, 'content': self.content}
+
+    def dump(self) -> dict:
+        """Dict to persist, keeps the token count when known"""
+        if self._tokens is None:
+            return self.to_dict()
+        return {'role': self.role, 'content': self.content, 'tokens': self._tokens}
+
+    @classmethod
+    def load(cls, message: Union[dict, 'Message']) -> 'Message':
+        """Message from a dict as produced by `dump` or `to_dict`"""
+        if isinstance(message, Message):
+            return message
+        return cls(message['role'], message['content'], message.get('tokens'))
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Message):
+            return NotImplemented
+        return self.role == other.role and self.content == other.content
+
+    def __repr__(self) -> str:
+        return f"Message(role={self.role!r}, content={self.content!r})"
 
 
 class Prompt:
@@ -21,14 +68,16 @@ class Prompt:
         if not self.default_base_prompt:
             self.default_base_prompt = "You are ChatGPT, a large language model trained by OpenAI."
         # Track chat history
-        self.chat_history: list = []
+        self.chat_history: List[Message] = []
         self.buffer = buffer
+        # prompt tokens of the last constructed messages, format overhead included
+        self.prompt_tokens = None
 
     def add_to_chat_history(self, chat_qa: List) -> None:
         """
         Add chat to chat history for next prompt
         """
-        self.chat_history.extend(chat_qa)
+        self.chat_history.extend(Message.load(m) for m in chat_qa)
 
     def add_to_history(
         self,
@@ -40,44 +89,77 @@ class Prompt:
         """
         self.add_to_chat_history(
             [
-                {'role': "user", 'content': user_request},
-                {'role': "system", 'content': response}]
+                Message("user", user_request),
+                Message("system", response)]
         )
 
-    def history(self, custom_history: list = None) -> str:
+    def history(self, custom_history: list = None) -> List[Message]:
         """
         Return chat history
         """
-        return custom_history or self.chat_history
+        if custom_history:
+            return [Message.load(m) for m in custom_history]
+        return self.chat_history
 
     def construct_prompt_messages(
         self,
         new_prompt: str,
         custom_history: list = None,
-        base_prompt: str = None
+        base_prompt: str = None,
+        model: str = CHAT_MODEL
     ) -> List[dict]:
         """
-        Construct prompt based on chat history and request
-        """
-        if not base_prompt:
-            base_prompt = self.default_base_prompt
-        messages = [{"role": "system", "content": base_prompt}] + \
-            self.history(custom_history=custom_history) + \
-            [{"role": "user", "content": new_prompt}]
-        # Check if prompt over 4000 tokens
-        if self.buffer is not None:
-            max_tokens = 4000 - self.buffer
-        else:
-            max_tokens = 3600
-        prompt = '\n\n'.join([m['content'] for m in messages])
-        if len(ENCODER.encode(prompt)) > max_tokens:
+        Construct prompt based on chat history and request,
+        dropping the oldest chat until it fits the prompt budget of the model
+        """
+        system_message = Message("system", base_prompt or self.default_base_prompt)
+        user_message = Message("user", new_prompt)
+        history = self.history(custom_history=custom_history)
+        return self._fit_prompt_messages(system_message, user_message, history, model)
+
+    async def aconstruct_prompt_messages(
+        self,
+        new_prompt: str,
+        custom_history: list = None,
+        base_prompt: str = None,
+        model: str = CHAT_MODEL
+    ) -> List[dict]:
+        """
+        Construct prompt like `construct_prompt_messages`,
+        large texts are tokenized off the event loop
+        """
+        system_message = Message("system", base_prompt or self.default_base_prompt)
+        user_message = Message("user", new_prompt)
+        history = self.history(custom_history=custom_history)
+        pending = [m for m in [system_message, user_message, *history] if m._tokens is None]
+        for message, tokens in zip(pending, await acount_tokens_batch([m.content for m in pending])):
+            message._tokens = tokens
+        return self._fit_prompt_messages(system_message, user_message, history, model)
+
+    def _fit_prompt_messages(
+        self,
+        system_message: Message,
+        user_message: Message,
+        history: List[Message],
+        model: str
+    ) -> List[dict]:
+        max_tokens = get_prompt_budget(model, reserve=self.buffer)
+        tokens = system_message.tokens + user_message.tokens + 2 * TOKENS_PER_MESSAGE + TOKENS_PER_REPLY
+        # keep the most recent chat that fits
+        keep = 0
+        for message in reversed(history):
+            if tokens + message.tokens + TOKENS_PER_MESSAGE > max_tokens:
+                break
+            tokens += message.tokens + TOKENS_PER_MESSAGE
+            keep += 1
+        self.prompt_tokens = tokens
+        if keep < len(history):
             # Remove oldest chat
-            if len(self.chat_history) == 0:
-                return messages
-            self.chat_history.pop(0)
-            # Construct prompt again
-            messages = self.construct_prompt_messages(new_prompt, custom_history)
-        return messages
+            if history is self.chat_history:
+                del self.chat_history[:len(history) - keep]
+            else:
+                history = history[len(history) - keep:]
+        return [system_message.to_dict()] + [m.to_dict() for m in history] + [user_message.to_dict()]
 
 
 SAVE_FILE = 'conversation.json'
@@ -85,17 +167,42 @@ SAVE_FILE = 'conversation.json'
 
 class Conversation:
     """
-    For handling multiple conversations
+    For handling multiple conversations,
+    saved conversations are loaded on first use
     """
 
-    def __init__(self) -> None:
-        self.conversations = {}
-        if os.path.exists(SAVE_FILE):
-            self.load(SAVE_FILE)
-        # Create a thread to call conversation_store.save every 10 minutes.
-        self.save_thread = threading.Thread(target=self._save_conversation_store)
-        self.save_thread.daemon = True
-        self.save_thread.start()
+    def __init__(self, file: str = SAVE_FILE) -> None:
+        self.file = file
+        self._conversations = None
+        self._lock = threading.Lock()
+        self.save_thread = None
+
+    @property
+    def conversations(self) -> dict:
+        if self._conversations is None:
+            self.start()
+        return self._conversations
+
+    @conversations.setter
+    def conversations(self, conversations: dict) -> None:
+        self._conversations = conversations
+
+    def start(self) -> None:
+        """
+        Load the saved conversations and start saving them periodically.
+        Runs in the worker process, the save thread would not survive a fork.
+        """
+        with self._lock:
+            if self._conversations is not None:
+                return
+            if os.path.exists(self.file):
+                self.load(self.file)
+            else:
+                self._conversations = {}
+            # Create a thread to call conversation_store.save every 10 minutes.
+            self.save_thread = threading.Thread(target=self._save_conversation_store)
+            self.save_thread.daemon = True
+            self.save_thread.start()
 
     def _save_conversation_store(self) -> None:
         """
@@ -103,7 +210,7 @@ class Conversation:
         """
         while True:
             time.sleep(600)
-            self.save(SAVE_FILE)
+            self.save(self.file)
 
     def add_conversation(self, key: str, history: list) -> None:
         """
@@ -127,7 +234,7 @@ class Conversation:
         """
         Creates a JSON string of the conversations
         """
-        return json.dumps(self.conversations)
+        return json.dumps(self.conversations, default=Message.dump)
 
     def save(self, file: str) -> None:
         """
@@ -141,7 +248,9 @@ class Conversation:
         Loads the conversations from a JSON file
         """
         with open(file, encoding="utf-8") as f:
-            self.conversations = json.loads(f.read())
+            self.conversations = {
+                key: [Message.load(m) for m in history]
+                for key, history in json.loads(f.read()).items()}
 
 
 conversation_store = Conversation()
@@ -0,0 +1,218 @@
+"""
+Hedged upstream requests: when the first attempt is slower than recent
+latency suggests, fire a second one and keep whichever answers first
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Awaitable, Callable, Dict, List, Optional, TypeVar
+
+T = TypeVar('T')
+
+
+class LatencyTracker:
+    """
+    Sliding window of recent latencies with percentile lookup
+    """
+
+    def __init__(self, window: int = 500) -> None:
+        self.samples = deque(maxlen=window)
+        self._sorted: Optional[List[float]] = None
+
+    def record(self, latency: float) -> None:
+        self.samples.append(latency)
+        self._sorted = None
+
+    def percentile(self, p: float) -> Optional[float]:
+        """
+        Return the `p`th percentile (0-100) of the window, None if empty
+        """
+        ordered = self._sorted
+        if ordered is None:
+            ordered = self._sorted = sorted(self.samples)
+        if not ordered:
+            return None
+        index = min(len(ordered) - 1, int(len(ordered) * p / 100.0))
+        return ordered[index]
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+
+class Hedger:
+    """
+    Run upstream calls with an optional hedge attempt.
+
+    The hedge is fired once the primary attempt has been running longer than
+    the `percentile` latency observed for the same key. Hedges are paid for
+    from a budget that earns `budget` credits per primary request, so hedging
+    adds at most that fraction of extra upstream load.
+    `upstreams` are extra keyword arguments for each attempt (e.g. `api_key`,
+    `api_base`), the hedge uses the second entry when there is one.
+    Sync attempts run in at most `max_workers` threads and never wait for
+    one: when all are busy, e.g. with stalled losers, the call runs in the
+    calling thread without a hedge.
+    """
+
+    def __init__(
+        self,
+        percentile: float = 95,
+        budget: float = 0.1,
+        min_delay: float = 0.2,
+        max_delay: float = 30.0,
+        default_delay: float = 10.0,
+        min_samples: int = 20,
+        upstreams: List[Dict] = None,
+        max_workers: int = 32
+    ) -> None:
+        self.percentile = percentile
+        self.budget = budget
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.default_delay = default_delay
+        self.min_samples = min_samples
+        self.upstreams = upstreams or [{}]
+        self.trackers: Dict[str, LatencyTracker] = {}
+        self._credits = 1.0
+        self._lock = threading.Lock()
+        self.max_workers = max_workers
+        # attempts submitted to the executor and not finished, losers included
+        self._in_flight = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='hedge')
+
+    def tracker(self, key: str) -> LatencyTracker:
+        tracker = self.trackers.get(key)
+        if tracker is None:
+            tracker = self.trackers.setdefault(key, LatencyTracker())
+        return tracker
+
+    def delay(self, key: str) -> float:
+        """
+        How long to wait for the primary attempt before hedging
+        """
+        tracker = self.tracker(key)
+        if len(tracker) < self.min_samples:
+            return self.default_delay
+        return min(self.max_delay, max(self.min_delay, tracker.percentile(self.percentile)))
+
+    def _earn(self) -> None:
+        with self._lock:
+            # cap the savings so an idle period cannot fund a burst of hedges
+            self._credits = min(self._credits + self.budget, max(1.0, self.budget * 10))
+
+    def _spend(self) -> bool:
+        with self._lock:
+            if self._credits < 1.0:
+                return False
+            self._credits -= 1.0
+            return True
+
+    def _refund(self) -> None:
+        with self._lock:
+            self._credits += 1.0
+
+    def _upstream(self, attempt: int) -> Dict:
+        return self.upstreams[min(attempt, len(self.upstreams) - 1)]
+
+    def _submit(self, fn: Callable[[int], T], index: int) -> Optional[Future]:
+        """
+        Run `fn(index)` in a free worker thread, None when every worker is busy
+        """
+        with self._lock:
+            if self._in_flight >= self.max_workers:
+                return None
+            self._in_flight += 1
+        future = self._executor.submit(fn, index)
+        future.add_done_callback(self._attempt_done)
+        return future
+
+    def _attempt_done(self, future: Future) -> None:
+        with self._lock:
+            self._in_flight -= 1
+
+    def call(self, key: str, attempt: Callable[[Dict], T]) -> T:
+        """
+        Call `attempt(upstream_kwargs)`, hedged. A losing attempt cannot be
+        interrupted in a worker thread, its result is simply discarded.
+        """
+        self._earn()
+        delay = self.delay(key)
+
+        def run(index: int):
+            started = time.monotonic()
+            result = attempt(self._upstream(index))
+            return result, time.monotonic() - started
+
+        primary = self._submit(run, 0)
+        if primary is None:
+            # queueing behind stalled attempts would only add latency
+            result, elapsed = run(0)
+            self.tracker(key).record(elapsed)
+            return result
+        pending = {primary}
+        done, _ = wait(pending, timeout=delay)
+        if not done and self._spend():
+            hedge = self._submit(run, 1)
+            if hedge is None:
+                self._refund()
+            else:
+                pending.add(hedge)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                for loser in pending:
+                    loser.cancel()
+                result, elapsed = future.result()
+                self.tracker(key).record(elapsed)
+                return result
+        raise error
+
+    async def acall(
+        self,
+        key: str,
+        attempt: Callable[[Dict], Awaitable[T]],
+        discard: Callable[[T], None] = None
+    ) -> T:
+        """
+        Await `attempt(upstream_kwargs)`, hedged. The losing attempt is
+        cancelled, or passed to `discard` if it completed at the same time.
+        """
+        self._earn()
+        delay = self.delay(key)
+        loop = asyncio.get_running_loop()
+
+        async def run(index: int):
+            started = loop.time()
+            result = await attempt(self._upstream(index))
+            return result, loop.time() - started
+
+        tasks = [asyncio.ensure_future(run(0))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and self._spend():
+                tasks.append(asyncio.ensure_future(run(1)))
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winners = [task for task in done if task.exception() is None]
+                if not winners:
+                    error = next(iter(done)).exception()
+                    continue
+                for task in winners[1:]:
+                    if discard is not None:
+                        discard(task.result()[0])
+                result, elapsed = winners[0].result()
+                self.tracker(key).record(elapsed)
+                return result
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
@@ -0,0 +1,98 @@
+"""
+Registry of OpenAI models: context window, output limit and pricing
+"""
+import json
+from functools import lru_cache
+from typing import Dict, NamedTuple
+
+from config import MODEL_REGISTRY_FILE
+
+
+class ModelInfo(NamedTuple):
+    """Limits and USD price per 1K tokens of a model"""
+    name: str
+    context_window: int
+    max_output_tokens: int
+    prompt_cost_per_1k: float = 0.0
+    completion_cost_per_1k: float = 0.0
+
+    def estimate_cost(self, prompt_tokens: int, completion_tokens: int = 0) -> float:
+        """
+        Estimate the USD cost of a request
+        """
+        return (prompt_tokens * self.prompt_cost_per_1k + completion_tokens * self.completion_cost_per_1k) / 1000
+
+
+MODELS: Dict[str, ModelInfo] = {}
+# used for unknown models
+DEFAULT_CONTEXT_WINDOW = 4096
+
+
+def register_model(
+    name: str,
+    context_window: int,
+    max_output_tokens: int = None,
+    prompt_cost_per_1k: float = 0.0,
+    completion_cost_per_1k: float = 0.0
+) -> ModelInfo:
+    """
+    Add or replace a model in the registry
+    """
+    info = ModelInfo(
+        name, context_window, context_window if max_output_tokens is None else max_output_tokens,
+        prompt_cost_per_1k, completion_cost_per_1k)
+    MODELS[name] = info
+    get_model.cache_clear()
+    return info
+
+
+def load_models(file: str) -> None:
+    """
+    Register models from a JSON file, a list of `register_model` keyword arguments
+    """
+    with open(file, encoding="utf-8") as f:
+        for entry in json.loads(f.read()):
+            register_model(**entry)
+
+
+@lru_cache(maxsize=256)
+def get_model(model: str) -> ModelInfo:
+    """
+    Look up a model, dated snapshots fall back to the longest registered prefix
+    """
+    if model in MODELS:
+        return MODELS[model]
+    prefixes = [name for name in MODELS if model.startswith(name)]
+    if prefixes:
+        return MODELS[max(prefixes, key=len)]
+    if '32k' in model:
+        return ModelInfo(model, 32768, 32768)
+    if '16k' in model:
+        return ModelInfo(model, 16385, 16385)
+    return ModelInfo(model, DEFAULT_CONTEXT_WINDOW, DEFAULT_CONTEXT_WINDOW)
+
+
+for _entry in (
+    # name, context window, max output tokens, prompt / completion USD per 1K tokens
+    ("gpt-3.5-turbo", 16385, 4096, 0.0005, 0.0015),
+    ("gpt-3.5-turbo-0125", 16385, 4096, 0.0005, 0.0015),
+    ("gpt-3.5-turbo-1106", 16385, 4096, 0.001, 0.002),
+    ("gpt-3.5-turbo-0613", 4096, 4096, 0.0015, 0.002),
+    ("gpt-3.5-turbo-0301", 4096, 4096, 0.0015, 0.002),
+    ("gpt-3.5-turbo-16k", 16385, 16385, 0.003, 0.004),
+    ("gpt-3.5-turbo-instruct", 4096, 4096, 0.0015, 0.002),
+    ("gpt-4", 8192, 8192, 0.03, 0.06),
+    ("gpt-4-32k", 32768, 32768, 0.06, 0.12),
+    ("gpt-4-1106-preview", 128000, 4096, 0.01, 0.03),
+    ("gpt-4-0125-preview", 128000, 4096, 0.01, 0.03),
+    ("gpt-4-turbo", 128000, 4096, 0.01, 0.03),
+    ("gpt-4o", 128000, 4096, 0.005, 0.015),
+    ("text-davinci-003", 4097, 4097, 0.02, 0.02),
+    ("text-embedding-ada-002", 8191, 0, 0.0001, 0.0),
+    ("text-embedding-3-small", 8191, 0, 0.00002, 0.0),
+    ("text-embedding-3-large", 8191, 0, 0.00013, 0.0),
+):
+    register_model(*_entry)
+
+if MODEL_REGISTRY_FILE:
+    load_models(MODEL_REGISTRY_FILE)
@@ -1,38 +1,210 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Union
+import numpy as np
 import tiktoken
 
+from config import TIKTOKEN_OFFLINE, TOKENIZE_OFFLOAD_CHARS, TOKENIZER_THREADS
+from .models import get_model
+
 # gpt-4, gpt-3.5-turbo, text-embedding-ada-002
-ENCODER = tiktoken.get_encoding("cl100k_base")
+ENCODING_NAME = "cl100k_base"
+VOCAB_URL = "https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken"
+# file name of the vocab in a tiktoken cache directory
+VOCAB_CACHE_KEY = hashlib.sha1(VOCAB_URL.encode()).hexdigest()
+# vocab shipped with the app, used unless TIKTOKEN_CACHE_DIR is set
+BUNDLED_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tiktoken_cache")
+_encoder = None
+_encoder_lock = threading.Lock()
+# tiktoken releases the GIL while encoding, so threads are enough to keep
+# large prompts off the event loop
+_tokenizer_executor = ThreadPoolExecutor(max_workers=TOKENIZER_THREADS, thread_name_prefix="tokenizer")
+
+# chat format overhead: every message is wrapped in <|start|>{role}\n{content}<|end|>\n
+# and every reply is primed with <|start|>assistant<|message|>
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+
+class ChatgptAPIException(Exception):
+    """ChatGPT API error
+    """
+    pass
+
+
+class ContextWindowExceeded(ChatgptAPIException):
+    """Prompt does not fit in the model context window
+    """
+    pass
+
+
+class TokenizerUnavailable(ChatgptAPIException):
+    """Tokenizer vocab is not cached and may not be downloaded (TIKTOKEN_OFFLINE)
+    """
+    pass
+
+
+def _vocab_cache_file() -> str:
+    """Where tiktoken looks for the cached vocab, None when caching is disabled"""
+    if "TIKTOKEN_CACHE_DIR" in os.environ:
+        cache_dir = os.environ["TIKTOKEN_CACHE_DIR"]
+    elif "DATA_GYM_CACHE_DIR" in os.environ:
+        cache_dir = os.environ["DATA_GYM_CACHE_DIR"]
+    else:
+        cache_dir = os.path.join(tempfile.gettempdir(), "data-gym-cache")
+    if not cache_dir:
+        return None
+    return os.path.join(cache_dir, VOCAB_CACHE_KEY)
+
+
+if "TIKTOKEN_CACHE_DIR" not in os.environ and os.path.exists(os.path.join(BUNDLED_CACHE_DIR, VOCAB_CACHE_KEY)):
+    # read the bundled vocab, see README
+    os.environ["TIKTOKEN_CACHE_DIR"] = BUNDLED_CACHE_DIR
+
+
+def get_encoder(download: bool = None) -> tiktoken.Encoding:
+    """
+    Tokenizer, built on first use. Call it in the parent process before
+    forking workers so they share it copy-on-write.
+    The vocab is downloaded when not cached, unless `download` is False
+    (default with TIKTOKEN_OFFLINE): then raise TokenizerUnavailable.
+    """
+    global _encoder
+    if _encoder is None:
+        with _encoder_lock:
+            if _encoder is None:
+                cache_file = _vocab_cache_file()
+                if not (not TIKTOKEN_OFFLINE if download is None else download) and not (
+                        cache_file and os.path.exists(cache_file)):
+                    raise TokenizerUnavailable(
+                        f"Tokenizer vocab {ENCODING_NAME} not found at {cache_file}, set TIKTOKEN_CACHE_DIR "
+                        f"or fill the cache on a node with internet access (see README)")
+                _encoder = tiktoken.get_encoding(ENCODING_NAME)
+    return _encoder
+
+
+def __getattr__(name: str):
+    # ENCODER is loaded lazily, importing this module stays cheap
+    if name == "ENCODER":
+        return get_encoder()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def get_model_token_limit(model: str) -> int:
     """get max limit of token by model"""
-    if model == 'gpt-4-1106-preview':
-        return 4000
-    elif model == 'gtp-4':
-        return 8000
-    elif model.find('16k') > 0:
-        return 16000
-    elif model.find('32k') > 0:
-        return 32000
-    else:
-        return 4000
+    return get_model(model).context_window
+
+
+def count_tokens(text: str) -> int:
+    """count tokens of a text"""
+    return len(get_encoder().encode(text))
+
 
+def count_tokens_batch(texts: List[str]) -> List[int]:
+    """count tokens of several texts"""
+    encoder = get_encoder()
+    return [len(encoder.encode(text)) for text in texts]
 
-def get_max_tokens(model: str, prompt: str, max_expect: int = 4000) -> int:
+
+def count_message_tokens(messages: List[dict]) -> int:
+    """
+    Count prompt tokens of chat messages, including the chat format overhead
+    """
+    return sum(count_tokens(m['content']) + TOKENS_PER_MESSAGE for m in messages) + TOKENS_PER_REPLY
+
+
+async def acount_tokens(text: str) -> int:
+    """
+    count tokens of a text, in the tokenizer threads when it is large
+    """
+    if len(text) < TOKENIZE_OFFLOAD_CHARS:
+        return count_tokens(text)
+    return await asyncio.get_running_loop().run_in_executor(_tokenizer_executor, count_tokens, text)
+
+
+async def acount_tokens_batch(texts: List[str]) -> List[int]:
+    """
+    count tokens of several texts, in the tokenizer threads when they are large
+    """
+    if sum(len(text) for text in texts) < TOKENIZE_OFFLOAD_CHARS:
+        return count_tokens_batch(texts)
+    return await asyncio.get_running_loop().run_in_executor(_tokenizer_executor, count_tokens_batch, texts)
+
+
+def get_prompt_budget(model: str, reserve: int = None) -> int:
+    """
+    Tokens left for the prompt after reserving `reserve` tokens for the answer,
+    by default a tenth of the context window up to the model output limit
     """
-    Get the max tokens for a complete message
+    info = get_model(model)
+    if reserve is None:
+        reserve = min(info.max_output_tokens, info.context_window // 10)
+    return info.context_window - reserve
+
+
+def get_max_tokens(
+        model: str, prompt: Union[str, List[dict]], max_expect: int = 4000, prompt_tokens: int = None) -> int:
     """
-    token_limit = get_model_token_limit(model)
-    max_tokens = token_limit - len(ENCODER.encode(prompt))
-    if max_tokens < 0:
-        return 512
-    elif max_tokens > max_expect:
-        return max_expect
+    Get the max tokens for a complete message,
+    raise ContextWindowExceeded when the prompt leaves no room for an answer.
+    The prompt is only tokenized when `prompt_tokens` is not known.
+    """
+    if prompt_tokens is None:
+        prompt_tokens = count_tokens(prompt) if isinstance(prompt, str) else count_message_tokens(prompt)
+    return _max_tokens(model, prompt_tokens, max_expect)
+
+
+async def aget_max_tokens(
+        model: str, prompt: Union[str, List[dict]], max_expect: int = 4000, prompt_tokens: int = None) -> int:
+    """
+    `get_max_tokens` for the event loop, large prompts are tokenized in the tokenizer threads
+    """
+    if prompt_tokens is not None:
+        return _max_tokens(model, prompt_tokens, max_expect)
+    if isinstance(prompt, str):
+        prompt_tokens = await acount_tokens(prompt)
     else:
-        return max_tokens
+        counts = await acount_tokens_batch([m['content'] for m in prompt])
+        prompt_tokens = sum(counts) + TOKENS_PER_MESSAGE * len(counts) + TOKENS_PER_REPLY
+    return _max_tokens(model, prompt_tokens, max_expect)
 
 
-class ChatgptAPIException(Exception):
-    """ChatGPT API error
+def _max_tokens(model: str, prompt_tokens: int, max_expect: int) -> int:
+    info = get_model(model)
+    max_tokens = info.context_window - prompt_tokens
+    if max_tokens <= 0:
+        raise ContextWindowExceeded(
+            f"Prompt of {prompt_tokens} tokens exceeds the {info.context_window} tokens context window of {model}")
+    return min(max_tokens, info.max_output_tokens, max_expect or max_tokens)
+
+
+def split_tokens(tokens: List[int], chunk_size: int, overlap: int = 0) -> List[Tuple[int, List[int]]]:
     """
-    pass
+    Split tokens in chunks of at most `chunk_size`, consecutive chunks share
+    `overlap` tokens. Return (offset of the first token, chunk) pairs,
+    none for no tokens.
+    """
+    if overlap >= chunk_size:
+        raise ValueError("overlap must be smaller than chunk_size")
+    if not tokens:
+        return []
+    step = chunk_size - overlap
+    chunks = []
+    for start in range(0, max(len(tokens) - overlap, 1), step):
+        chunks.append((start, tokens[start:start + chunk_size]))
+    return chunks
+
+
+def pool_embeddings(vectors: List[List[float]], weights: List[int]) -> List[float]:
+    """
+    Weighted mean of embedding vectors, normalized to unit length like the vectors themselves
+    """
+    pooled = np.average(np.asarray(vectors, dtype=np.float64), axis=0, weights=weights)
+    norm = np.linalg.norm(pooled)
+    if norm > 0:
+        pooled /= norm
+    return pooled.tolist()
@@ -0,0 +1,275 @@
+"""
+Named collections of embedding vectors with top-k cosine search.
+
+Each collection is a directory holding the vectors as one contiguous
+float32 matrix (`vectors.f32`, memory-mapped for search) and one JSON line
+of row, id and metadata per vector (`records.jsonl`). Adds append to both
+files, the existing rows are never rewritten.
+
+Several processes may share a collection: adds hold an exclusive lock on
+the `lock` file, and every process picks up the rows appended by the
+others before adding or searching.
+"""
+import json
+import os
+import re
+import threading
+import uuid
+from typing import Dict, List
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # no cross-process locking, run a single worker
+    fcntl = None
+
+from config import VECTOR_STORE_DIR
+from .utils import ChatgptAPIException
+
+COLLECTION_NAME = re.compile(r'^[A-Za-z0-9_\-]{1,64}$')
+
+
+class VectorStoreException(ChatgptAPIException):
+    """Invalid vector store operation
+    """
+    pass
+
+
+class _FileLock:
+    """`flock` on a file, shared or exclusive"""
+
+    def __init__(self, path: str, exclusive: bool) -> None:
+        self.path = path
+        self.exclusive = exclusive
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, "a")
+        if fcntl is not None:
+            fcntl.flock(self.file, fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        # closing the file releases the lock
+        self.file.close()
+
+
+class Collection:
+    """
+    Append-only vector collection, vectors are normalized when added so
+    cosine similarity is a dot product
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.dim = None
+        self.records: List[dict] = []
+        self._vectors = None
+        self._lock = threading.Lock()
+        # bytes of records.jsonl read so far
+        self._offset = 0
+        # metadata key -> value -> rows, built on first filter by the key
+        self._postings: Dict[str, Dict[str, List[int]]] = {}
+        if os.path.exists(self._info_file):
+            with self._lock, self._file_lock(exclusive=True):
+                self._repair()
+                self._refresh()
+
+    @property
+    def _info_file(self) -> str:
+        return os.path.join(self.path, 'info.json')
+
+    @property
+    def _vectors_file(self) -> str:
+        return os.path.join(self.path, 'vectors.f32')
+
+    @property
+    def _records_file(self) -> str:
+        return os.path.join(self.path, 'records.jsonl')
+
+    def _file_lock(self, exclusive: bool) -> _FileLock:
+        return _FileLock(os.path.join(self.path, 'lock'), exclusive)
+
+    def _repair(self) -> None:
+        """
+        Cut both files back to their complete rows, an add that was
+        interrupted may have left a row in only one of them. Needs the
+        exclusive file lock, so no other process is appending.
+        """
+        with open(self._info_file, encoding="utf-8") as f:
+            self.dim = json.loads(f.read())['dim']
+        with open(self._records_file, "rb") as f:
+            f.seek(self._offset)
+            lines = [line for line in f if line.endswith(b'\n')]
+        complete = len(self.records) + len(lines)
+        rows = min(complete, os.path.getsize(self._vectors_file) // (4 * self.dim))
+        if rows < len(self.records):
+            raise VectorStoreException(f"Collection {self.path} was truncated")
+        os.truncate(self._vectors_file, rows * 4 * self.dim)
+        os.truncate(self._records_file, self._offset + sum(len(line) for line in lines[:rows - len(self.records)]))
+
+    def _refresh(self) -> None:
+        """
+        Read the rows appended since the last refresh, by this or another
+        process. Records are written after their vectors, so every
+        complete record line has its vector on disk.
+        """
+        if self.dim is None:
+            if not os.path.exists(self._info_file):
+                return
+            with open(self._info_file, encoding="utf-8") as f:
+                self.dim = json.loads(f.read())['dim']
+        if os.path.getsize(self._records_file) == self._offset and self._vectors is not None:
+            return
+        with open(self._records_file, "rb") as f:
+            f.seek(self._offset)
+            data = f.read()
+        data = data[:data.rfind(b'\n') + 1]
+        records = [json.loads(line) for line in data.splitlines()]
+        start = len(self.records)
+        for row, record in enumerate(records, start):
+            if record.get('row', row) != row:
+                raise VectorStoreException(f"Collection {self.path} is corrupt at row {row}")
+        self._offset += len(data)
+        self._append_records(records)
+
+    def _append_records(self, records: List[dict]) -> None:
+        start = len(self.records)
+        self.records.extend(records)
+        for key, postings in self._postings.items():
+            for row, record in enumerate(records, start):
+                if key in record['metadata']:
+                    postings.setdefault(_value_key(record['metadata'][key]), []).append(row)
+        self._map(len(self.records))
+
+    def _map(self, rows: int) -> None:
+        if rows:
+            self._vectors = np.memmap(self._vectors_file, dtype=np.float32, mode='r', shape=(rows, self.dim))
+        else:
+            self._vectors = np.empty((0, self.dim or 0), dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def add(self, vectors: List[List[float]], ids: List[str] = None, metadatas: List[dict] = None) -> List[str]:
+        """
+        Append vectors with optional ids and metadata, return the ids
+        """
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if matrix.ndim != 2 or not len(matrix):
+            raise VectorStoreException("Expected a non-empty list of vectors")
+        ids = ids or [uuid.uuid4().hex for _ in range(len(matrix))]
+        metadatas = metadatas or [{} for _ in range(len(matrix))]
+        if not len(ids) == len(metadatas) == len(matrix):
+            raise VectorStoreException("ids and metadatas must match the vectors")
+        # row norms without a temporary of the matrix size
+        norms = np.sqrt(np.einsum('ij,ij->i', matrix, matrix))[:, None]
+        matrix = matrix / np.where(norms > 0, norms, 1)
+
+        os.makedirs(self.path, exist_ok=True)
+        with self._lock, self._file_lock(exclusive=True):
+            if self.dim is None and not os.path.exists(self._info_file):
+                with open(self._records_file, "ab"), open(self._vectors_file, "ab"):
+                    pass
+                with open(self._info_file, "w", encoding="utf-8") as f:
+                    f.write(json.dumps({'dim': matrix.shape[1]}))
+            self._refresh()
+            if matrix.shape[1] != self.dim:
+                raise VectorStoreException(f"Expected vectors of dimension {self.dim}, got {matrix.shape[1]}")
+            self._repair()
+            start = len(self.records)
+            records = [{'row': row, 'id': id_, 'metadata': metadata}
+                       for row, (id_, metadata) in enumerate(zip(ids, metadatas), start)]
+            with open(self._vectors_file, "ab") as f:
+                f.write(matrix.tobytes())
+            data = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records).encode("utf-8")
+            with open(self._records_file, "ab") as f:
+                f.write(data)
+            # still locked, the appended rows are ours
+            self._offset += len(data)
+            self._append_records(records)
+        return ids
+
+    def _filter_rows(self, filters: dict, rows: int) -> np.ndarray:
+        """Rows whose metadata equals every filter value"""
+        candidates = None
+        for key, value in filters.items():
+            with self._lock:
+                if key not in self._postings:
+                    postings = {}
+                    for row, record in enumerate(self.records):
+                        if key in record['metadata']:
+                            postings.setdefault(_value_key(record['metadata'][key]), []).append(row)
+                    self._postings[key] = postings
+                matches = np.asarray(self._postings[key].get(_value_key(value), []), dtype=np.int64)
+            matches = matches[matches < rows]
+            candidates = matches if candidates is None else np.intersect1d(candidates, matches, assume_unique=True)
+        return candidates
+
+    def search(self, vector: List[float], top_k: int = 10, filters: dict = None) -> List[dict]:
+        """
+        Return the `top_k` most similar rows as {'id', 'score', 'metadata'}
+        """
+        if os.path.exists(self._info_file):
+            with self._lock, self._file_lock(exclusive=False):
+                self._refresh()
+        vectors = self._vectors
+        if vectors is None or not len(vectors):
+            return []
+        query = np.array(vector, dtype=np.float32)
+        if query.shape != (self.dim,):
+            raise VectorStoreException(f"Expected a query of dimension {self.dim}, got {query.shape[-1]}")
+        query /= np.linalg.norm(query) or 1
+        if filters:
+            rows = self._filter_rows(filters, len(vectors))
+            scores = vectors[rows] @ query
+        else:
+            rows = None
+            scores = np.asarray(vectors @ query)
+        top_k = min(top_k, len(scores))
+        if not top_k:
+            return []
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        results = []
+        for index in best:
+            row = int(index if rows is None else rows[index])
+            record = self.records[row]
+            results.append({'id': record['id'], 'score': float(scores[index]), 'metadata': record['metadata']})
+        return results
+
+
+def _value_key(value) -> str:
+    return json.dumps(value, sort_keys=True)
+
+
+class VectorStore:
+    """
+    For handling multiple collections, opened on first use
+    """
+
+    def __init__(self, root: str = VECTOR_STORE_DIR) -> None:
+        self.root = root
+        self.collections: Dict[str, Collection] = {}
+        self._lock = threading.Lock()
+
+    def exists(self, name: str) -> bool:
+        if name in self.collections:
+            return True
+        return bool(COLLECTION_NAME.match(name)) and os.path.exists(os.path.join(self.root, name, 'info.json'))
+
+    def get_collection(self, name: str) -> Collection:
+        """
+        Open or create the collection with this name
+        """
+        if not COLLECTION_NAME.match(name):
+            raise VectorStoreException(f"Invalid collection name {name!r}")
+        with self._lock:
+            if name not in self.collections:
+                self.collections[name] = Collection(os.path.join(self.root, name))
+            return self.collections[name]
+
+
+vector_store = VectorStore()
@@ -9,3 +9,49 @@ GPT_ENGINE = os.environ.get("GPT_ENGINE") or "text-davinci-003"
 CHAT_MODEL = os.environ.get("CHAT_MODEL") or "gpt-3.5-turbo-0613"
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 PROMPTWATCH_API_KEY = os.getenv("PROMPTWATCH_API_KEY")
+
+# admission control for upstream calls, per JWT subject
+ADMISSION_MAX_CONCURRENCY = int(os.environ.get("ADMISSION_MAX_CONCURRENCY") or 16)
+ADMISSION_PER_USER_CONCURRENCY = int(os.environ.get("ADMISSION_PER_USER_CONCURRENCY") or 2)
+ADMISSION_TOKENS_PER_MINUTE = int(os.environ.get("ADMISSION_TOKENS_PER_MINUTE") or 0) or None
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE") or 64)
+ADMISSION_PER_USER_QUEUE = int(os.environ.get("ADMISSION_PER_USER_QUEUE") or 8)
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT") or 30)
+
+# http timeout of a single upstream call, in seconds
+UPSTREAM_REQUEST_TIMEOUT = float(os.environ.get("UPSTREAM_REQUEST_TIMEOUT") or 60)
+# opt-in hedged upstream requests
+HEDGE_ENABLED = os.environ.get("HEDGE_ENABLED", "").lower() in ("1", "true", "yes")
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE") or 95)
+# max fraction of extra upstream requests added by hedging
+HEDGE_BUDGET = float(os.environ.get("HEDGE_BUDGET") or 0.1)
+# optional alternative key / endpoint for the hedge attempt
+HEDGE_API_KEY = os.getenv("HEDGE_API_KEY")
+HEDGE_API_BASE = os.getenv("HEDGE_API_BASE")
+# optional JSON file extending / overriding the built-in model registry
+MODEL_REGISTRY_FILE = os.getenv("MODEL_REGISTRY_FILE")
+
+# logging
+LOG_LEVEL = os.environ.get("LOG_LEVEL") or "INFO"
+# forked workers (gunicorn --preload) write to "openai-api.<pid>.log" next to it
+LOG_FILE = os.environ.get("LOG_FILE") or "logs/openai-api.log"
+LOG_FILE_MAX_BYTES = int(os.environ.get("LOG_FILE_MAX_BYTES") or 50 * 1024 * 1024)
+LOG_FILE_BACKUP_COUNT = int(os.environ.get("LOG_FILE_BACKUP_COUNT") or 5)
+# fraction of requests whose prompt body is logged
+LOG_PROMPT_SAMPLE_RATE = float(os.environ.get("LOG_PROMPT_SAMPLE_RATE") or 0)
+
+# fail fast instead of downloading the tokenizer vocab when it is not cached, for air-gapped nodes
+TIKTOKEN_OFFLINE = os.environ.get("TIKTOKEN_OFFLINE", "").lower() in ("1", "true", "yes")
+# load the tokenizer when main is imported, e.g. in the parent process of `gunicorn --preload`
+PRELOAD_TOKENIZER = os.environ.get("PRELOAD_TOKENIZER", "").lower() in ("1", "true", "yes")
+# prompts longer than this (in characters) are tokenized off the event loop
+TOKENIZE_OFFLOAD_CHARS = int(os.environ.get("TOKENIZE_OFFLOAD_CHARS") or 16000)
+TOKENIZER_THREADS = int(os.environ.get("TOKENIZER_THREADS") or 4)
+# per request limits of the embedding API, long texts are embedded in batches
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE") or 2048)
+EMBEDDING_BATCH_TOKENS = int(os.environ.get("EMBEDDING_BATCH_TOKENS") or 100000)
+# directory of the vector collections
+VECTOR_STORE_DIR = os.environ.get("VECTOR_STORE_DIR") or "vector_store"
+# responses larger than this (in bytes) are gzip compressed for clients accepting it
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE") or 1024)
+COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL") or 6)
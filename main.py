@@ -1,5 +1,9 @@
+import asyncio
 import json
 import logging
+import random
+import time
+import uuid
 import aiohttp
 import requests
 from logging.config import dictConfig
@@ -10,18 +14,39 @@ from fastapi_jwt_auth import AuthJWT
 from fastapi_jwt_auth.exceptions import AuthJWTException
 import openai
 from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
-from chatgpt import Chatbot, AsyncChatbot
-from config import OPENAI_API_KEY
-from utils.log_config import LogConfig
-from utils.schema import ChatRequest, EmbeddingRequest, AuthSettings, User
+from starlette.concurrency import run_in_threadpool
+from chatgpt import Chatbot, AsyncChatbot, ContextWindowExceeded, TokenizerUnavailable, preload, startup
+from chatgpt.vector_store import Collection, VectorStoreException, vector_store
+from config import (
+    OPENAI_API_KEY, ADMISSION_MAX_CONCURRENCY, ADMISSION_PER_USER_CONCURRENCY, ADMISSION_TOKENS_PER_MINUTE,
+    ADMISSION_MAX_QUEUE, ADMISSION_PER_USER_QUEUE, ADMISSION_QUEUE_TIMEOUT, LOG_PROMPT_SAMPLE_RATE,
+    PRELOAD_TOKENIZER, COMPRESS_MIN_SIZE, COMPRESS_LEVEL)
+from utils.admission import AdmissionController, AdmissionRejected, estimate_tokens
+from utils.compression import (
+    UPSTREAM_ACCEPT_ENCODING, ContentDecodingError, decompress, forwardable_headers, is_accepted)
+from utils.log_config import LogConfig, request_id_var
+from utils.schema import ChatRequest, EmbeddingRequest, SearchRequest, AuthSettings, User
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 
 
 app = FastAPI()
 
-dictConfig(LogConfig().dict())
-logger = logging.getLogger("mycoolapp")
+if PRELOAD_TOKENIZER:
+    preload()
+
+log_config = LogConfig()
+dictConfig(log_config.dict())
+logger = logging.getLogger(log_config.LOGGER_NAME)
+
+admission = AdmissionController(
+    max_concurrency=ADMISSION_MAX_CONCURRENCY,
+    per_user_concurrency=ADMISSION_PER_USER_CONCURRENCY,
+    tokens_per_minute=ADMISSION_TOKENS_PER_MINUTE,
+    max_queue=ADMISSION_MAX_QUEUE,
+    per_user_queue=ADMISSION_PER_USER_QUEUE,
+    queue_timeout=ADMISSION_QUEUE_TIMEOUT)
 
 
 origins = [
@@ -38,6 +63,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# compress large responses for clients accepting gzip, responses that
+# already have a content-encoding (proxied ones) are left alone
+app.add_middleware(GZipMiddleware, minimum_size=COMPRESS_MIN_SIZE, compresslevel=COMPRESS_LEVEL)
+
 
 @app.middleware("http")
 async def add_cors_headers(request, call_next):
@@ -49,6 +78,33 @@ async def add_cors_headers(request, call_next):
     return response
 
 
+# loading of the tokenizer and conversations, see `startup_event`
+startup_future = None
+
+
+@app.on_event("startup")
+async def startup_event():
+    # load the tokenizer and conversations off the event loop so the worker
+    # starts serving right away, requests needing them wait for the load
+    global startup_future
+    startup_future = asyncio.get_running_loop().run_in_executor(None, startup)
+    startup_future.add_done_callback(log_startup_error)
+
+
+async def wait_startup() -> None:
+    """
+    Wait for the startup load without blocking the event loop, code running
+    on the loop would otherwise block on the tokenizer or conversation locks
+    """
+    if startup_future is not None:
+        await asyncio.shield(startup_future)
+
+
+def log_startup_error(future: asyncio.Future) -> None:
+    if future.exception() is not None:
+        logger.error("Startup failed: %s", future.exception())
+
+
 @AuthJWT.load_config
 def get_config():
     return AuthSettings()
@@ -85,29 +141,135 @@ def authjwt_exception_handler(request: Request, exc: AuthJWTException):
     )
 
 
+@app.exception_handler(AdmissionRejected)
+def admission_exception_handler(request: Request, exc: AdmissionRejected):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": exc.detail},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+
+@app.exception_handler(ContextWindowExceeded)
+def context_window_exception_handler(request: Request, exc: ContextWindowExceeded):
+    return JSONResponse(
+        status_code=400,
+        content={"detail": str(exc)}
+    )
+
+
+@app.exception_handler(TokenizerUnavailable)
+def tokenizer_exception_handler(request: Request, exc: TokenizerUnavailable):
+    logger.error("Tokenizer unavailable: %s", exc)
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Tokenizer is not available on this server, try again later"}
+    )
+
+
+@app.exception_handler(VectorStoreException)
+def vector_store_exception_handler(request: Request, exc: VectorStoreException):
+    return JSONResponse(
+        status_code=400,
+        content={"detail": str(exc)}
+    )
+
+
+def log_fields(user: str, model: str, started: float, prompt: str = None, usage: dict = None) -> dict:
+    """
+    Structured fields of a request log record, the prompt body is sampled
+    """
+    fields = {'user': user, 'model': model, 'latency_ms': round((time.monotonic() - started) * 1000, 1)}
+    if usage:
+        fields['prompt_tokens'] = usage.get('prompt_tokens')
+        fields['completion_tokens'] = usage.get('completion_tokens')
+    if prompt is not None and random.random() < LOG_PROMPT_SAMPLE_RATE:
+        fields['prompt'] = prompt
+    return fields
+
+
+def settle(ticket, usage: dict) -> None:
+    """
+    Settle the estimated admission cost with the tokens reported upstream
+    """
+    if usage and usage.get('total_tokens') is not None:
+        ticket.used = usage['total_tokens']
+
+
 @app.post("/chat", summary="ChatGPT接口")
-def chat(ask: ChatRequest, authorize: AuthJWT = Depends()):
+async def chat(ask: ChatRequest, authorize: AuthJWT = Depends()):
     authorize.jwt_required()
     current_user = authorize.get_jwt_subject()
-    logger.debug(current_user + "->" + ask.message)
+    started = time.monotonic()
     # Initialize chatbot
     chatbot_ins = Chatbot(api_key=OPENAI_API_KEY)
     try:
-        return chatbot_ins.ask(
-            ask.message, conversation_id=ask.conversationId, temperature=ask.temperature,
-            model=ask.model, max_tokens=ask.max_tokens, base_prompt=ask.base_prompt)
+        # wait for admission on the event loop, so queued requests hold no
+        # threadpool thread, then run the blocking upstream call
+        cost = estimate_tokens(ask.message, ask.max_tokens, ask.model)
+        async with admission.admit_async(current_user, cost) as ticket:
+            result = await run_in_threadpool(
+                chatbot_ins.ask, ask.message, conversation_id=ask.conversationId, temperature=ask.temperature,
+                model=ask.model, max_tokens=ask.max_tokens, base_prompt=ask.base_prompt)
+            settle(ticket, chatbot_ins.usage)
     except openai.error.RateLimitError as exc:
         return JSONResponse(
             status_code=500,
             content={"detail": str(exc)}
         )
+    logger.info("chat", extra=log_fields(current_user, ask.model, started, ask.message, chatbot_ins.usage))
+    return result
 
 
 @app.post("/embedding", summary="Embedding接口")
-def embedding(args: EmbeddingRequest, authorize: AuthJWT = Depends()):
+async def embedding(args: EmbeddingRequest, authorize: AuthJWT = Depends()):
     authorize.jwt_required()
+    current_user = authorize.get_jwt_subject()
+    started = time.monotonic()
+    # open the collection first, an invalid name fails before calling upstream
+    collection = await run_in_threadpool(vector_store.get_collection, args.collection) if args.collection else None
     chatbot_ins = Chatbot(api_key=OPENAI_API_KEY)
-    return chatbot_ins.text_embedding(args.text, args.model)
+    async with admission.admit_async(current_user, estimate_tokens(args.text)) as ticket:
+        result = await run_in_threadpool(
+            chatbot_ins.text_embedding, args.text, args.model,
+            chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap, pool=args.pool)
+        settle(ticket, chatbot_ins.usage)
+    if collection is not None:
+        await run_in_threadpool(store_embeddings, collection, args, result)
+    logger.info("embedding", extra=log_fields(current_user, args.model, started, args.text, chatbot_ins.usage))
+    return result
+
+
+def store_embeddings(collection: Collection, args: EmbeddingRequest, result) -> None:
+    """
+    Add the vectors of an embedding response to its collection
+    """
+    metadata = args.metadata or {}
+    if args.chunk_size and not args.pool:
+        vectors = [chunk['embedding'] for chunk in result]
+        metadatas = [dict(metadata, offset=chunk['offset'], tokens=chunk['tokens']) for chunk in result]
+        ids = [f"{args.document_id}:{n}" for n in range(len(result))] if args.document_id else None
+    else:
+        vectors, metadatas = [result], [metadata]
+        ids = [args.document_id] if args.document_id else None
+    collection.add(vectors, ids, metadatas)
+
+
+@app.post("/search", summary="向量检索接口")
+async def search(args: SearchRequest, authorize: AuthJWT = Depends()):
+    authorize.jwt_required()
+    current_user = authorize.get_jwt_subject()
+    if not vector_store.exists(args.collection):
+        raise HTTPException(status_code=404, detail="Collection not found")
+    started = time.monotonic()
+    chatbot_ins = Chatbot(api_key=OPENAI_API_KEY)
+    async with admission.admit_async(current_user, estimate_tokens(args.query)) as ticket:
+        vector = await run_in_threadpool(chatbot_ins.text_embedding, args.query, args.model)
+        settle(ticket, chatbot_ins.usage)
+    collection = await run_in_threadpool(vector_store.get_collection, args.collection)
+    results = await run_in_threadpool(collection.search, vector, args.top_k, args.filters)
+    logger.info("search", extra=log_fields(current_user, args.model, started, args.query, chatbot_ins.usage))
+    return results
 
 
 @app.websocket("/chat_stream", name="ChatGPT流式接口")
@@ -122,23 +284,42 @@ async def websocket_endpoint(websocket: WebSocket, authorize: AuthJWT = Depends(
 
     while True:
         message = await websocket.receive_text()
-        logger.debug(f'received message: {str(message)}')
         if message is None:
             break
         message = json.loads(message)
-        if current_user:
-            logger.info(current_user + "->" + message['prompt'])
+        request_id_var.set(uuid.uuid4().hex)
+        started = time.monotonic()
+        try:
+            await wait_startup()
+        except Exception as ex:
+            await websocket.send_json({'state': 'ERROR', 'details': str(ex)})
+            continue
+        try:
+            ticket = await admission.acquire_async(
+                current_user, estimate_tokens(message['prompt'], message['max_tokens'], message['model']))
+        except AdmissionRejected as ex:
+            await websocket.send_json({'state': 'ERROR', 'details': ex.detail, 'retryAfter': ex.retry_after})
+            continue
         try:
             words = await chatbot_ins.ask_stream(
                 message['prompt'], conversation_id=message['conversationId'], temperature=message['temperature'],
                 model=message['model'], max_tokens=message['max_tokens'], base_prompt=message.get('base_prompt'))
         except Exception as ex:
+            admission.release(ticket)
             logger.error("Error occurred while calling OpenAI API: %s", ex)
             await websocket.send_json({'state': 'ERROR', 'details': str(ex)})
             continue
 
-        async for word in words:
-            await websocket.send(word)
+        response = []
+        try:
+            async for word in words:
+                response.append(word)
+                await websocket.send(word)
+        finally:
+            # streams report no usage, settle with an estimate of what was sent
+            ticket.used = estimate_tokens(message['prompt'] + ''.join(response))
+            admission.release(ticket)
+        logger.info("chat_stream", extra=log_fields(current_user, message['model'], started, message['prompt']))
         await websocket.send_json({'state': 'EMD', 'conversationId': chatbot_ins.conversation_id})
 
 
@@ -149,10 +330,12 @@ class OpenAIProxy(BaseHTTPMiddleware):
 
     async def proxy(self, request: Request, call_next: RequestResponseEndpoint):
         url = self.base_url + request.url.path.replace('/api', '')
-        headers = {k: v for k, v in request.headers.items() if k != "host"}
-        # openapi cannot accept content-encoding: gzip
-        headers['accept-encoding'] = 'identity'
-        async with aiohttp.ClientSession() as client:
+        headers = [
+            (k, v) for k, v in forwardable_headers(request.headers) if k.lower() not in ('host', 'accept-encoding')]
+        # ask for a compressed response whatever the client accepts, it is
+        # decompressed here only for clients that cannot decode it
+        headers.append(('accept-encoding', UPSTREAM_ACCEPT_ENCODING))
+        async with aiohttp.ClientSession(auto_decompress=False) as client:
             async with client.request(
                 method=request.method,
                 url=url,
@@ -160,7 +343,20 @@ class OpenAIProxy(BaseHTTPMiddleware):
                 data=await request.body(),
             ) as resp:
                 body = await resp.read()
-                return Response(body, status_code=resp.status, headers=resp.headers)
+                headers = forwardable_headers(resp.headers)
+                encoding = resp.headers.get('content-encoding')
+                if encoding and not is_accepted(encoding, request.headers.get('accept-encoding')):
+                    try:
+                        body = decompress(body, encoding)
+                    except ContentDecodingError as ex:
+                        logger.error("Cannot decode upstream response: %s", ex)
+                        return JSONResponse(status_code=502, content={"detail": "Bad upstream response"})
+                    headers = [(k, v) for k, v in headers if k.lower() != 'content-encoding']
+                response = Response(body, status_code=resp.status)
+                # raw pairs, repeated headers such as Set-Cookie are kept
+                response.raw_headers.extend((k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers)
+                response.headers.add_vary_header('Accept-Encoding')
+                return response
 
 
 @app.middleware("http")
@@ -173,6 +369,20 @@ async def add_proxy_middleware(request: Request, call_next: RequestResponseEndpo
     else:
         return await call_next(request)
 
+
+@app.middleware("http")
+async def log_requests(request: Request, call_next: RequestResponseEndpoint):
+    request_id = request.headers.get('x-request-id') or uuid.uuid4().hex
+    request_id_var.set(request_id)
+    started = time.monotonic()
+    response = await call_next(request)
+    response.headers['X-Request-ID'] = request_id
+    logger.info("request", extra={
+        'path': request.url.path, 'status': response.status_code,
+        'latency_ms': round((time.monotonic() - started) * 1000, 1)})
+    return response
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, ws='websockets')
@@ -0,0 +1,21 @@
+import os
+import pytest
+import tiktoken
+import chatgpt.utils
+
+
+@pytest.fixture(autouse=True, scope="session")
+def tokenizer():
+    """
+    Use the cached vocab when there is one, a byte level encoding otherwise,
+    so the tests never depend on downloading the vocab
+    """
+    cache_file = chatgpt.utils._vocab_cache_file()
+    if cache_file and os.path.exists(cache_file):
+        yield chatgpt.utils.get_encoder()
+        return
+    chatgpt.utils._encoder = tiktoken.Encoding(
+        name="test_bytes", pat_str=r"\S+|\s+", mergeable_ranks={bytes([i]): i for i in range(256)},
+        special_tokens={"<|endoftext|>": 256})
+    yield chatgpt.utils._encoder
+    chatgpt.utils._encoder = None
@@ -0,0 +1,108 @@
+import asyncio
+import threading
+import time
+import pytest
+from utils.admission import AdmissionController, AdmissionRejected, estimate_tokens
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("abcdefgh", 100) == 103
+    assert estimate_tokens(None) == 1
+
+
+def test_per_user_concurrency_and_queue_full():
+    controller = AdmissionController(max_concurrency=4, per_user_concurrency=1, per_user_queue=1, queue_timeout=0.05)
+    ticket = controller.acquire("heavy", 10)
+    # second request waits in the queue and times out
+    with pytest.raises(AdmissionRejected):
+        controller.acquire("heavy", 10)
+    # other users are not affected
+    with controller.admit("light", 10):
+        pass
+    controller.release(ticket)
+    with controller.admit("heavy", 10):
+        pass
+
+
+def test_queue_full_rejects_immediately():
+    controller = AdmissionController(max_concurrency=1, per_user_concurrency=1, max_queue=1, queue_timeout=5)
+    ticket = controller.acquire("a", 10)
+    waiter = threading.Thread(target=lambda: controller.release(controller.acquire("b", 10)))
+    waiter.start()
+    while controller._queued == 0:
+        pass
+    with pytest.raises(AdmissionRejected) as exc:
+        controller.acquire("c", 10)
+    assert exc.value.retry_after >= 1
+    controller.release(ticket)
+    waiter.join()
+
+
+def test_token_quota():
+    controller = AdmissionController(tokens_per_minute=6000)
+    with controller.admit("a", 5000):
+        pass
+    with pytest.raises(AdmissionRejected) as exc:
+        controller.acquire("a", 5000)
+    assert exc.value.retry_after >= 40
+    with controller.admit("b", 5000):
+        pass
+
+
+def test_fair_scheduling_across_subjects():
+    controller = AdmissionController(max_concurrency=1, per_user_concurrency=1, quantum=100)
+    blocker = controller.acquire("blocker", 1)
+    order = []
+
+    async def request(subject, cost):
+        async with controller.admit_async(subject, cost):
+            order.append(subject)
+            await asyncio.sleep(0)
+
+    async def run():
+        tasks = [asyncio.ensure_future(request("heavy", 400)) for _ in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.ensure_future(request("light", 50)))
+        await asyncio.sleep(0)
+        controller.release(blocker)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    # the light request is not stuck behind every heavy one
+    assert order.index("light") < 2
+
+
+def test_estimate_capped_by_model():
+    assert estimate_tokens("abcdefgh", 8000, "gpt-4-1106-preview") == 3 + 4096
+    # a long prompt leaves little room for the completion
+    assert estimate_tokens("a" * 16000, 4000, "gpt-3.5-turbo-0613") == 4096
+
+
+def test_quota_refunded_and_settled():
+    controller = AdmissionController(max_concurrency=1, tokens_per_minute=6000, queue_timeout=0.05)
+    blocker = controller.acquire("b", 1)
+    # a request timing out in the queue gets its tokens back
+    with pytest.raises(AdmissionRejected):
+        controller.acquire("a", 5000)
+    controller.release(blocker)
+    # the estimate is settled with the tokens actually used
+    with controller.admit("a", 5000) as ticket:
+        ticket.used = 100
+    with controller.admit("a", 5000):
+        pass
+    with pytest.raises(AdmissionRejected):
+        controller.acquire("a", 5000)
+
+
+def test_idle_subjects_are_forgotten(monkeypatch):
+    controller = AdmissionController(tokens_per_minute=6000)
+    for i in range(100):
+        with controller.admit("user-%d" % i, 600):
+            pass
+    assert len(controller._subjects) == 100
+    # a minute later every bucket has refilled
+    now = time.monotonic() + 61
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    with controller.admit("other", 600):
+        pass
+    assert list(controller._subjects) == ["other"]
@@ -0,0 +1,104 @@
+import asyncio
+import gzip
+import threading
+import zlib
+import pytest
+from aiohttp import web
+from starlette.applications import Starlette
+from starlette.routing import Route
+from starlette.testclient import TestClient
+from utils.compression import (
+    ContentDecodingError, accepted_encodings, decompress, forwardable_headers, is_accepted)
+
+BODY = b'{"text": "hello"}' * 100
+
+
+def test_accepted_encodings():
+    assert accepted_encodings("gzip, deflate;q=0.5, br;q=0") == {"gzip", "deflate"}
+    assert accepted_encodings(None) == set()
+    assert is_accepted("gzip", "GZIP, br")
+    assert not is_accepted("br", "gzip, br;q=0")
+    assert not is_accepted("gzip", None)
+    assert is_accepted("identity", None)
+    assert is_accepted("gzip", "*")
+    # every coding of a stacked encoding must be accepted
+    assert is_accepted("deflate, gzip", "gzip, deflate")
+    assert not is_accepted("deflate, gzip", "gzip")
+
+
+def test_decompress():
+    assert decompress(gzip.compress(BODY), "gzip") == BODY
+    assert decompress(gzip.compress(zlib.compress(BODY)), "deflate, gzip") == BODY
+    raw = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    assert decompress(raw.compress(BODY) + raw.flush(), "deflate") == BODY
+    with pytest.raises(ContentDecodingError):
+        decompress(BODY, "compress")
+    with pytest.raises(ContentDecodingError):
+        decompress(BODY, "gzip")
+
+
+def test_forwardable_headers():
+    headers = [
+        ("Content-Type", "application/json"),
+        ("Content-Length", "10"),
+        ("Connection", "keep-alive, X-Upstream-Hop"),
+        ("X-Upstream-Hop", "1"),
+        ("Transfer-Encoding", "chunked"),
+        ("Set-Cookie", "a=1"),
+        ("Set-Cookie", "b=2"),
+    ]
+    assert forwardable_headers(headers) == [
+        ("Content-Type", "application/json"), ("Set-Cookie", "a=1"), ("Set-Cookie", "b=2")]
+    assert forwardable_headers({"Content-Encoding": "gzip", "Keep-Alive": "5"}) == [("Content-Encoding", "gzip")]
+
+
+@pytest.fixture
+def upstream():
+    """Local upstream server with compressed responses, yields its base url"""
+    async def handler(request):
+        headers = [("Content-Type", "application/json"), ("Set-Cookie", "a=1"), ("Set-Cookie", "b=2")]
+        if request.path == "/corrupt":
+            body, encoding = b"not gzip", "gzip"
+        else:
+            body, encoding = gzip.compress(BODY), "gzip"
+        response = web.Response(body=body, headers=headers)
+        response.headers["Content-Encoding"] = encoding
+        return response
+
+    loop = asyncio.new_event_loop()
+    app = web.Application()
+    app.router.add_get("/{path}", handler)
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{port}"
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.run_until_complete(runner.cleanup())
+    loop.close()
+
+
+def test_proxy_passes_compressed_body_through(upstream):
+    from main import OpenAIProxy
+
+    async def proxy(request):
+        return await OpenAIProxy(None, upstream).proxy(request, None)
+
+    client = TestClient(Starlette(routes=[Route("/api/{path}", proxy)]))
+    # forwarded as is to a client decoding gzip
+    with client.stream("GET", "/api/data", headers={"accept-encoding": "gzip"}) as response:
+        assert response.headers["content-encoding"] == "gzip"
+        assert gzip.decompress(b"".join(response.iter_raw())) == BODY
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert response.headers.get_list("set-cookie") == ["a=1", "b=2"]
+    # decoded for the others
+    response = client.get("/api/data", headers={"accept-encoding": "identity"})
+    assert "content-encoding" not in response.headers
+    assert response.content == BODY
+    assert response.status_code == 200
+    response = client.get("/api/corrupt", headers={"accept-encoding": "identity"})
+    assert response.status_code == 502
@@ -0,0 +1,87 @@
+import asyncio
+import sys
+from chatgpt.conversation_store import Conversation, Message, Prompt
+
+
+def test_message_records():
+    message = Message("".join(["us", "er"]), "hello", tokens=1)
+    assert message.role is sys.intern("user")
+    assert message.to_dict() == {'role': 'user', 'content': 'hello'}
+    assert message.dump() == {'role': 'user', 'content': 'hello', 'tokens': 1}
+    assert Message.load(message.dump()) == message
+    assert not hasattr(message, '__dict__')
+
+
+def test_prompt_messages_are_dicts():
+    prompt = Prompt()
+    prompt.add_to_history("question", "answer")
+    prompt.add_to_chat_history([{'role': 'user', 'content': 'again'}])
+    assert all(isinstance(m, Message) for m in prompt.chat_history)
+    messages = prompt.construct_prompt_messages("new", model="gpt-4")
+    assert all(isinstance(m, dict) for m in messages)
+    assert [m['content'] for m in messages[1:]] == ["question", "answer", "again", "new"]
+    custom = prompt.construct_prompt_messages("new", custom_history=[{'role': 'user', 'content': 'custom'}], model="gpt-4")
+    assert custom[1] == {'role': 'user', 'content': 'custom'}
+
+
+def test_conversation_save_and_load(tmp_path):
+    store = Conversation()
+    prompt = Prompt()
+    prompt.add_to_history("question", "answer")
+    prompt.construct_prompt_messages("new", model="gpt-4")
+    store.add_conversation("abc", prompt.chat_history)
+    file = str(tmp_path / "conversation.json")
+    store.save(file)
+    store.load(file)
+    history = store.get_conversation("abc")
+    assert history == prompt.chat_history
+    assert history[0]._tokens is not None
+
+
+def test_conversation_loaded_on_first_use(tmp_path):
+    file = tmp_path / "conversation.json"
+    file.write_text('{"abc": [{"role": "user", "content": "hello"}]}', encoding="utf-8")
+    store = Conversation(file=str(file))
+    assert store._conversations is None and store.save_thread is None
+    assert store.get_conversation("abc") == [Message("user", "hello")]
+    assert store.save_thread.is_alive()
+
+
+def test_async_construct_matches_sync():
+    prompt = Prompt()
+    for i in range(5):
+        prompt.add_to_history("question %d" % i, "answer %d" % i)
+    expected = prompt.construct_prompt_messages("new", model="gpt-4")
+    prompt.chat_history = [Message(m.role, m.content) for m in prompt.chat_history]
+    assert asyncio.run(prompt.aconstruct_prompt_messages("new", model="gpt-4")) == expected
+    assert all(m._tokens is not None for m in prompt.chat_history)
+
+
+def test_ask_encodes_only_new_messages(monkeypatch, tmp_path):
+    import openai
+    import chatgpt.chatgpt_api
+    from chatgpt import Chatbot
+    from chatgpt.utils import get_encoder
+
+    encoder = get_encoder()
+    encode = encoder.encode
+    encoded = []
+
+    def counting_encode(text, *args, **kwargs):
+        encoded.append(len(text))
+        return encode(text, *args, **kwargs)
+
+    def create(**params):
+        return {'id': 'x', 'choices': [{'message': {'content': 'answer ' * 50}}]}
+
+    monkeypatch.setattr(encoder, "encode", counting_encode)
+    monkeypatch.setattr(openai.ChatCompletion, "create", create)
+    monkeypatch.setattr(chatgpt.chatgpt_api, "conversation_store", Conversation(file=str(tmp_path / "c.json")))
+    chatbot = Chatbot(api_key="test")
+    per_ask = []
+    for turn in range(10):
+        encoded.clear()
+        chatbot.ask("question %d " % turn * 20, conversation_id="abc", model="gpt-4")
+        per_ask.append(sum(encoded))
+    # the history is counted once, each ask only encodes its new messages
+    assert max(per_ask[2:]) == min(per_ask[2:])
@@ -0,0 +1,67 @@
+import numpy as np
+import openai
+import pytest
+from chatgpt import Chatbot, ChatgptAPIException
+from chatgpt.utils import count_tokens, pool_embeddings, split_tokens
+
+
+def test_split_tokens():
+    assert split_tokens(list(range(10)), 4, 1) == [(0, [0, 1, 2, 3]), (3, [3, 4, 5, 6]), (6, [6, 7, 8, 9])]
+    assert split_tokens(list(range(4)), 4, 1) == [(0, [0, 1, 2, 3])]
+    assert split_tokens([], 4, 1) == []
+    with pytest.raises(ValueError):
+        split_tokens(list(range(10)), 4, 4)
+
+
+def test_pool_embeddings():
+    pooled = pool_embeddings([[1.0, 0.0], [0.0, 1.0]], [3, 1])
+    assert np.allclose(pooled, np.array([3.0, 1.0]) / np.sqrt(10))
+
+
+def test_chunked_embedding_is_batched(monkeypatch):
+    calls = []
+
+    def create(input, model, **kwargs):
+        calls.append(input)
+        data = [{'index': i, 'embedding': [float(len(chunk)), 1.0]} for i, chunk in enumerate(input)]
+        return {'data': data[::-1], 'usage': {'prompt_tokens': sum(map(len, input)), 'total_tokens': sum(map(len, input))}}
+
+    monkeypatch.setattr(openai.Embedding, "create", create)
+    text = "lorem ipsum dolor sit amet " * 200
+    chatbot = Chatbot(api_key="test")
+    chunks = chatbot.text_embedding(text, chunk_size=100, chunk_overlap=10)
+    assert len(calls) == 1
+    assert [c['offset'] for c in chunks] == list(range(0, 90 * len(chunks), 90))
+    assert chunks[0] == {'embedding': [100.0, 1.0], 'offset': 0, 'tokens': 100}
+    assert chatbot.usage['prompt_tokens'] == sum(c['tokens'] for c in chunks)
+    assert chunks[-1]['offset'] + chunks[-1]['tokens'] == count_tokens(text)
+
+    monkeypatch.setattr("chatgpt.chatgpt_api.EMBEDDING_BATCH_TOKENS", 250)
+    calls.clear()
+    assert chatbot.text_embedding(text, chunk_size=100, chunk_overlap=10) == chunks
+    assert len(calls) == (len(chunks) + 1) // 2
+
+    pooled = chatbot.text_embedding(text, chunk_size=100, pool=True)
+    assert len(pooled) == 2 and np.isclose(np.linalg.norm(pooled), 1.0)
+
+
+def test_empty_text_rejected():
+    from pydantic import ValidationError
+    from utils.schema import EmbeddingRequest
+    with pytest.raises(ValidationError):
+        EmbeddingRequest(text="", chunk_size=100, pool=True)
+    with pytest.raises(ChatgptAPIException):
+        Chatbot(api_key="test").text_embedding("", chunk_size=100, pool=True)
+
+
+def test_chunk_size_capped_to_model_window():
+    from pydantic import ValidationError
+    from chatgpt import ContextWindowExceeded
+    from chatgpt.models import get_model
+    from utils.schema import EmbeddingRequest
+    window = get_model("text-embedding-ada-002").context_window
+    assert EmbeddingRequest(text="x", chunk_size=window + 1000).chunk_size == window
+    with pytest.raises(ValidationError):
+        EmbeddingRequest(text="x", chunk_size=window + 1000, chunk_overlap=window)
+    with pytest.raises(ContextWindowExceeded):
+        Chatbot(api_key="test").text_embedding("hello", chunk_size=window + 1000, chunk_overlap=window)
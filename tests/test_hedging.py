@@ -0,0 +1,114 @@
+import asyncio
+import threading
+import time
+import pytest
+from chatgpt.hedging import Hedger, LatencyTracker
+
+
+def test_latency_percentile():
+    tracker = LatencyTracker(window=100)
+    assert tracker.percentile(95) is None
+    for i in range(100):
+        tracker.record(i / 100)
+    assert tracker.percentile(50) == 0.5
+    assert tracker.percentile(100) == 0.99
+
+
+def test_hedge_wins_over_stalled_primary():
+    hedger = Hedger(default_delay=0.05, budget=1, upstreams=[{'api_key': 'a'}, {'api_key': 'b'}])
+    calls = []
+
+    def attempt(upstream):
+        calls.append(upstream['api_key'])
+        if upstream['api_key'] == 'a':
+            time.sleep(1)
+        return upstream['api_key']
+
+    started = time.monotonic()
+    assert hedger.call('chat', attempt) == 'b'
+    assert time.monotonic() - started < 0.5
+    assert calls == ['a', 'b']
+
+
+def test_hedge_budget():
+    hedger = Hedger(default_delay=0.01, budget=0)
+    hedger._credits = 0
+    calls = []
+
+    def attempt(upstream):
+        calls.append(1)
+        time.sleep(0.05)
+        return 'ok'
+
+    assert hedger.call('chat', attempt) == 'ok'
+    assert len(calls) == 1
+
+
+def test_primary_error_is_raised():
+    hedger = Hedger(default_delay=1)
+
+    def attempt(upstream):
+        raise ValueError("upstream down")
+
+    with pytest.raises(ValueError):
+        hedger.call('chat', attempt)
+
+
+def test_async_hedge_cancels_loser():
+    hedger = Hedger(default_delay=0.05, budget=1, upstreams=[{'name': 'slow'}, {'name': 'fast'}])
+    cancelled = []
+
+    async def attempt(upstream):
+        try:
+            if upstream['name'] == 'slow':
+                await asyncio.sleep(1)
+            return upstream['name']
+        except asyncio.CancelledError:
+            cancelled.append(upstream['name'])
+            raise
+
+    async def run():
+        result = await hedger.acall('chat', attempt)
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(run()) == 'fast'
+    assert cancelled == ['slow']
+    assert len(hedger.tracker('chat')) == 1
+
+
+def test_stalled_upstream_does_not_queue_calls():
+    hedger = Hedger(default_delay=0.05, budget=1, upstreams=[{'name': 'stalled'}, {'name': 'fast'}], max_workers=4)
+    lock = threading.Lock()
+    workers = []
+    most_workers = []
+
+    def attempt(upstream):
+        in_worker = threading.current_thread().name.startswith('hedge')
+        with lock:
+            workers.append(in_worker)
+            most_workers.append(sum(workers))
+        try:
+            if upstream['name'] == 'stalled':
+                time.sleep(0.5)
+            return upstream['name']
+        finally:
+            with lock:
+                workers.remove(in_worker)
+
+    elapsed = []
+
+    def call():
+        started = time.monotonic()
+        hedger.call('chat', attempt)
+        elapsed.append(time.monotonic() - started)
+
+    threads = [threading.Thread(target=call) for _ in range(12)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # no call waits for a worker held by a stalled attempt, busy workers
+    # make the calls run inline without a hedge
+    assert max(elapsed) < 0.9
+    assert max(most_workers) <= 4
@@ -0,0 +1,73 @@
+import json
+import logging
+import os
+import pytest
+from utils.log_config import AsyncRotatingFileHandler, JsonFormatter, RequestIdFilter, request_id_var
+
+
+def test_async_file_handler_writes_json(tmp_path):
+    file = tmp_path / "logs" / "app.log"
+    handler = AsyncRotatingFileHandler(str(file), maxBytes=4000, backupCount=10)
+    handler.setFormatter(JsonFormatter())
+    handler.addFilter(RequestIdFilter())
+    logger = logging.getLogger("test-async-log")
+    logger.propagate = False
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+    request_id_var.set("req-1")
+    logger.info("chat %s", "done", extra={'user': 'alice', 'model': 'gpt-4', 'latency_ms': 12.5})
+    for i in range(100):
+        logger.info("line %d", i)
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        logger.exception("failed")
+    handler.close()
+    logger.removeHandler(handler)
+
+    lines = []
+    for path in sorted(tmp_path.glob("logs/app.log*"), reverse=True):
+        lines += path.read_text(encoding="utf-8").splitlines()
+    assert (tmp_path / "logs" / "app.log.1").exists()
+    last = json.loads(lines[-1])
+    assert last['message'] == "failed"
+    assert "ValueError: boom" in last['exc']
+    assert last['request_id'] == "req-1"
+    first = [json.loads(line) for line in lines if '"chat done"' in line]
+    assert first[0]['user'] == 'alice' and first[0]['latency_ms'] == 12.5
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+def test_forked_children_write_and_rotate_their_own_files(tmp_path):
+    file = tmp_path / "app.log"
+    handler = AsyncRotatingFileHandler(str(file), maxBytes=20000, backupCount=1000)
+    handler.setFormatter(JsonFormatter())
+    logger = logging.getLogger("test-async-log-fork")
+    logger.propagate = False
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+    logger.info("parent")
+    children = []
+    for child in range(4):
+        pid = os.fork()
+        if pid == 0:
+            for i in range(500):
+                logger.info("child %d record %d", child, i)
+            handler.close()
+            os._exit(0)
+        children.append(pid)
+    for pid in children:
+        os.waitpid(pid, 0)
+    logger.info("parent done")
+    handler.close()
+    logger.removeHandler(handler)
+
+    messages = []
+    for path in tmp_path.glob("app*.log*"):
+        messages += [json.loads(line)['message'] for line in path.read_text(encoding="utf-8").splitlines()]
+    assert sorted(messages) == sorted(
+        ["parent", "parent done"] + ["child %d record %d" % (c, i) for c in range(4) for i in range(500)])
+    for pid in children:
+        assert (tmp_path / f"app.{pid}.log").exists()
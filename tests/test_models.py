@@ -0,0 +1,78 @@
+import asyncio
+import pytest
+from chatgpt.models import get_model, register_model
+from chatgpt.utils import ContextWindowExceeded, count_tokens, get_max_tokens, get_model_token_limit, get_prompt_budget
+from chatgpt.conversation_store import Prompt
+
+
+def test_model_lookup():
+    assert get_model_token_limit("gpt-4") == 8192
+    assert get_model_token_limit("gpt-4-0613") == 8192
+    assert get_model_token_limit("gpt-4-32k-0613") == 32768
+    assert get_model_token_limit("gpt-4-1106-preview") == 128000
+    assert get_model_token_limit("gpt-3.5-turbo-16k-0613") == 16385
+    assert get_model_token_limit("my-custom-16k") == 16385
+    assert get_model_token_limit("unknown") == 4096
+
+
+def test_register_model_and_cost():
+    info = register_model("test-model", 1000, 100, 1.0, 2.0)
+    assert get_model("test-model-001") == info
+    assert info.estimate_cost(1000, 500) == 2.0
+
+
+def test_max_tokens_budget():
+    assert get_max_tokens("gpt-4-1106-preview", "hello", 8000) == 4096
+    assert get_max_tokens("gpt-4", "hello", 100) == 100
+    assert get_max_tokens("gpt-4", "hello", 9000) == 8192 - count_tokens("hello")
+    with pytest.raises(ContextWindowExceeded):
+        get_max_tokens("gpt-3.5-turbo-0613", "hello " * 5000)
+
+
+def test_history_trimmed_to_model_window():
+    register_model("tiny-model", 200, 50)
+    prompt = Prompt()
+    for i in range(20):
+        prompt.add_to_history("question %d " % i * 5, "answer %d " % i * 5)
+    messages = prompt.construct_prompt_messages("new question", model="tiny-model")
+    assert len(messages) < 42
+    assert messages[-1]['content'] == "new question"
+    assert messages[-2]['content'] == prompt.chat_history[-1].content
+    assert len(messages) == len(prompt.chat_history) + 2
+    # a larger window keeps everything
+    prompt = Prompt()
+    prompt.add_to_history("question", "answer")
+    assert len(prompt.construct_prompt_messages("new", model="gpt-4")) == 4
+    assert get_prompt_budget("gpt-4") == 8192 - 819
+
+
+def test_async_max_tokens_matches_sync(monkeypatch):
+    import chatgpt.utils
+    monkeypatch.setattr(chatgpt.utils, "TOKENIZE_OFFLOAD_CHARS", 10)
+    messages = [{'role': 'system', 'content': 'You are a helpful assistant.'}, {'role': 'user', 'content': 'hello ' * 100}]
+    assert asyncio.run(chatgpt.utils.acount_tokens("hello " * 100)) == count_tokens("hello " * 100)
+    assert asyncio.run(chatgpt.utils.aget_max_tokens("gpt-4", messages, 9000)) == get_max_tokens("gpt-4", messages, 9000)
+
+
+def test_tokenizer_fails_fast_without_vocab(monkeypatch, tmp_path):
+    import chatgpt.utils
+    monkeypatch.setenv("TIKTOKEN_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(chatgpt.utils, "_encoder", None)
+    with pytest.raises(chatgpt.utils.TokenizerUnavailable):
+        chatgpt.utils.get_encoder(download=False)
+
+
+def test_tokenizer_unavailable_is_503(monkeypatch):
+    import chatgpt.utils
+    import main
+    from fastapi.testclient import TestClient
+    from fastapi_jwt_auth import AuthJWT
+
+    def ask(self, *args, **kwargs):
+        raise chatgpt.utils.TokenizerUnavailable("no vocab")
+
+    monkeypatch.setattr(main.Chatbot, "ask", ask)
+    token = AuthJWT().create_access_token(subject="alice")
+    response = TestClient(main.app).post(
+        "/chat", json={"message": "hello"}, headers={"authorization": "Bearer %s" % token})
+    assert response.status_code == 503
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from chatgpt.vector_store import Collection, VectorStore, VectorStoreException
+
+
+def test_add_and_search(tmp_path):
+    collection = Collection(str(tmp_path / "docs"))
+    assert collection.search([1.0, 0.0]) == []
+    ids = collection.add([[1.0, 0.0], [0.0, 2.0], [1.0, 1.0]], ids=["a", "b", "c"],
+                         metadatas=[{'lang': 'en'}, {'lang': 'zh'}, {'lang': 'en'}])
+    assert ids == ["a", "b", "c"]
+    results = collection.search([2.0, 0.1], top_k=2)
+    assert [r['id'] for r in results] == ["a", "c"]
+    assert results[0]['score'] == pytest.approx(2 / np.linalg.norm([2.0, 0.1]), rel=1e-5)
+    assert [r['id'] for r in collection.search([0.0, 1.0], top_k=5, filters={'lang': 'en'})] == ["c", "a"]
+    assert collection.search([0.0, 1.0], filters={'lang': 'fr'}) == []
+    with pytest.raises(VectorStoreException):
+        collection.add([[1.0, 0.0, 0.0]])
+
+
+def test_incremental_add_appends(tmp_path):
+    path = str(tmp_path / "docs")
+    collection = Collection(path)
+    collection.add([[1.0, 0.0]], ids=["a"], metadatas=[{'n': 1}])
+    collection.search([1.0, 0.0], filters={'n': 2})
+    size = (tmp_path / "docs" / "vectors.f32").stat().st_size
+    collection.add([[0.0, 1.0]], ids=["b"], metadatas=[{'n': 2}])
+    assert (tmp_path / "docs" / "vectors.f32").stat().st_size == 2 * size
+    assert [r['id'] for r in collection.search([1.0, 0.0], filters={'n': 2})] == ["b"]
+
+    # reopened from disk, a torn write is cut off
+    with open(path + "/vectors.f32", "ab") as f:
+        f.write(b"\0" * 4)
+    reopened = Collection(path)
+    assert len(reopened) == 2
+    reopened.add([[1.0, 1.0]], ids=["c"])
+    assert [r['id'] for r in Collection(path).search([1.0, 1.0], top_k=1)] == ["c"]
+
+
+def test_collection_names(tmp_path):
+    store = VectorStore(str(tmp_path))
+    with pytest.raises(VectorStoreException):
+        store.get_collection("../etc")
+    assert not store.exists("../etc")
+    assert not store.exists("docs")
+    store.get_collection("docs").add([[1.0]])
+    assert VectorStore(str(tmp_path)).exists("docs")
+
+
+def test_collection_shared_between_processes(tmp_path):
+    # two handles on one directory stand in for two workers
+    path = str(tmp_path / "docs")
+    first, second = Collection(path), Collection(path)
+    first.add([[1.0, 0.0, 0.0]], ids=["a-x"])
+    second.add([[0.0, 1.0, 0.0]], ids=["b-y"])
+    first.add([[0.0, 0.0, 1.0]], ids=["a-z"])
+    for collection in (first, second, Collection(path)):
+        assert [collection.search(vector, top_k=1)[0]['id'] for vector in ([1, 0, 0], [0, 1, 0], [0, 0, 1])] == \
+            ["a-x", "b-y", "a-z"]
+        assert len(collection) == 3
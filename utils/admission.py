@@ -0,0 +1,300 @@
+"""
+Per-user admission control with fair queuing across JWT subjects
+"""
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable, Dict, Optional
+
+from chatgpt.models import get_model
+
+
+class AdmissionRejected(Exception):
+    """Request rejected by admission control, client should retry later
+    """
+
+    def __init__(self, detail: str, retry_after: int = 1) -> None:
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+def estimate_tokens(text: str, max_tokens: int = 0, model: str = None) -> int:
+    """
+    Cheap estimate of the tokens a request will cost (prompt + completion).
+    About 4 characters per token, good enough for scheduling decisions.
+    With a model, the completion is capped to what the model can return.
+    """
+    prompt = len(text or '') // 4 + 1
+    completion = max_tokens or 0
+    if model is not None:
+        info = get_model(model)
+        completion = min(completion, info.max_output_tokens, max(info.context_window - prompt, 0))
+    return prompt + completion
+
+
+class _Ticket:
+    """
+    A request waiting for, or holding, an upstream slot. Set `used` to the
+    tokens actually spent before release to settle the estimated cost.
+    """
+    __slots__ = ('subject', 'cost', 'charged', 'used', 'granted', 'granted_at', 'notify')
+
+    def __init__(self, subject: str, cost: int, notify: Callable[[], None]) -> None:
+        self.subject = subject
+        self.cost = cost
+        # tokens taken from the quota
+        self.charged = 0
+        self.used: Optional[int] = None
+        self.granted = False
+        self.granted_at = 0.0
+        self.notify = notify
+
+
+class _SubjectState:
+    """Scheduling and quota state of a single subject"""
+    __slots__ = ('active', 'waiting', 'deficit', 'tokens', 'updated')
+
+    def __init__(self, tokens: float) -> None:
+        self.active = 0
+        self.waiting = deque()
+        self.deficit = 0
+        self.tokens = tokens
+        self.updated = time.monotonic()
+
+
+class AdmissionController:
+    """
+    Limit upstream concurrency per subject and globally.
+
+    Requests over the limits wait in a bounded queue, which is served with
+    deficit round-robin weighted by the estimated tokens of each request, so a
+    heavy user cannot starve the others. When the queue is full, the token
+    quota is exhausted or the wait times out, `AdmissionRejected` is raised
+    with a `retry_after` hint in seconds.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 16,
+        per_user_concurrency: int = 2,
+        tokens_per_minute: Optional[int] = None,
+        max_queue: int = 64,
+        per_user_queue: int = 8,
+        queue_timeout: float = 30.0,
+        quantum: int = 1000
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        self.per_user_concurrency = per_user_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.max_queue = max_queue
+        self.per_user_queue = per_user_queue
+        self.queue_timeout = queue_timeout
+        self.quantum = quantum
+        self._lock = threading.Lock()
+        self._subjects: Dict[str, _SubjectState] = {}
+        # subjects with waiting tickets, in round-robin order
+        self._round_robin = deque()
+        self._active = 0
+        self._queued = 0
+        # moving average of how long a slot is held, used for Retry-After
+        self._avg_hold = 1.0
+        self._last_sweep = time.monotonic()
+
+    def _state(self, subject: str) -> _SubjectState:
+        state = self._subjects.get(subject)
+        if state is None:
+            state = _SubjectState(self.tokens_per_minute or 0)
+            self._subjects[subject] = state
+        return state
+
+    def _charge_quota(self, state: _SubjectState, cost: int) -> int:
+        """
+        Take `cost` tokens from the subject's bucket, refilled continuously.
+        Return the tokens taken.
+        """
+        if not self.tokens_per_minute:
+            return 0
+        now = time.monotonic()
+        rate = self.tokens_per_minute / 60.0
+        state.tokens = min(self.tokens_per_minute, state.tokens + (now - state.updated) * rate)
+        state.updated = now
+        # a single request larger than the quota would otherwise never pass
+        cost = min(cost, self.tokens_per_minute)
+        if state.tokens < cost:
+            raise AdmissionRejected(
+                "Token quota exceeded", retry_after=(cost - state.tokens) / rate)
+        state.tokens -= cost
+        return cost
+
+    def _is_idle(self, state: _SubjectState, now: float) -> bool:
+        """
+        No request of the subject is active or queued and its bucket is full
+        again, so forgetting it changes nothing
+        """
+        if state.active or state.waiting:
+            return False
+        if not self.tokens_per_minute:
+            return True
+        return state.tokens + (now - state.updated) * self.tokens_per_minute / 60.0 >= self.tokens_per_minute
+
+    def _sweep(self) -> None:
+        """
+        Forget idle subjects, at most once a minute. Must be called with the lock held.
+        """
+        now = time.monotonic()
+        if now - self._last_sweep < 60:
+            return
+        self._last_sweep = now
+        for subject in [s for s, state in self._subjects.items() if self._is_idle(state, now)]:
+            del self._subjects[subject]
+
+    def _refund(self, state: _SubjectState, tokens: int) -> None:
+        """
+        Give tokens back to the bucket, or take more when negative
+        """
+        if self.tokens_per_minute:
+            state.tokens = min(self.tokens_per_minute, state.tokens + tokens)
+
+    def _retry_after(self) -> float:
+        return self._avg_hold * (self._queued + 1) / self.max_concurrency
+
+    def _grant(self, state: _SubjectState, ticket: _Ticket) -> None:
+        state.active += 1
+        self._active += 1
+        ticket.granted = True
+        ticket.granted_at = time.monotonic()
+        ticket.notify()
+
+    def _dispatch(self) -> None:
+        """
+        Hand free slots to waiting tickets with deficit round-robin.
+        Must be called with the lock held.
+        """
+        while self._active < self.max_concurrency and self._round_robin:
+            if all(self._subjects[s].active >= self.per_user_concurrency for s in self._round_robin):
+                return
+            subject = self._round_robin[0]
+            state = self._subjects[subject]
+            if state.active >= self.per_user_concurrency:
+                self._round_robin.rotate(-1)
+                continue
+            ticket = state.waiting[0]
+            if ticket.cost > state.deficit:
+                state.deficit += self.quantum
+                self._round_robin.rotate(-1)
+                continue
+            state.waiting.popleft()
+            self._queued -= 1
+            state.deficit -= ticket.cost
+            if not state.waiting:
+                state.deficit = 0
+                self._round_robin.popleft()
+            self._grant(state, ticket)
+
+    def _enqueue(self, subject: str, cost: int, notify: Callable[[], None]) -> _Ticket:
+        with self._lock:
+            self._sweep()
+            state = self._state(subject)
+            if self._queued >= self.max_queue or len(state.waiting) >= self.per_user_queue:
+                raise AdmissionRejected("Too many queued requests", retry_after=self._retry_after())
+            ticket = _Ticket(subject, cost, notify)
+            ticket.charged = self._charge_quota(state, cost)
+            if not state.waiting:
+                self._round_robin.append(subject)
+            state.waiting.append(ticket)
+            self._queued += 1
+            self._dispatch()
+            return ticket
+
+    def _withdraw(self, ticket: _Ticket) -> bool:
+        """
+        Remove a ticket that gave up waiting, False if it was granted meanwhile
+        """
+        with self._lock:
+            if ticket.granted:
+                return False
+            state = self._subjects[ticket.subject]
+            state.waiting.remove(ticket)
+            self._queued -= 1
+            self._refund(state, ticket.charged)
+            if not state.waiting:
+                state.deficit = 0
+                self._round_robin.remove(ticket.subject)
+            return True
+
+    def release(self, ticket: _Ticket) -> None:
+        """
+        Give back the slot held by a granted ticket, settling its cost with
+        `ticket.used` when set
+        """
+        with self._lock:
+            state = self._subjects[ticket.subject]
+            if ticket.used is not None:
+                self._refund(state, ticket.charged - ticket.used)
+                if state.waiting:
+                    # credit, or debit, the subject's turn in the round-robin
+                    state.deficit += ticket.cost - ticket.used
+            state.active -= 1
+            self._active -= 1
+            self._avg_hold = 0.9 * self._avg_hold + 0.1 * (time.monotonic() - ticket.granted_at)
+            if self._is_idle(state, time.monotonic()):
+                del self._subjects[ticket.subject]
+            self._dispatch()
+
+    def acquire(self, subject: str, cost: int) -> _Ticket:
+        """
+        Block until the subject may call upstream, return the ticket to release
+        """
+        event = threading.Event()
+        ticket = self._enqueue(subject, cost, event.set)
+        if not event.wait(self.queue_timeout) and self._withdraw(ticket):
+            raise AdmissionRejected("Timed out waiting in queue", retry_after=self._retry_after())
+        return ticket
+
+    async def acquire_async(self, subject: str, cost: int) -> _Ticket:
+        """
+        Wait without blocking the event loop until the subject may call upstream
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        ticket = self._enqueue(subject, cost, notify)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if self._withdraw(ticket):
+                raise AdmissionRejected("Timed out waiting in queue", retry_after=self._retry_after())
+        except asyncio.CancelledError:
+            if not self._withdraw(ticket):
+                self.release(ticket)
+            raise
+        return ticket
+
+    @contextmanager
+    def admit(self, subject: str, cost: int):
+        """
+        Hold an upstream slot for the duration of the block
+        """
+        ticket = self.acquire(subject, cost)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    @asynccontextmanager
+    async def admit_async(self, subject: str, cost: int):
+        """
+        Async version of `admit`
+        """
+        ticket = await self.acquire_async(subject, cost)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
@@ -0,0 +1,115 @@
+"""
+Content-encoding negotiation and header cleanup for the upstream proxy
+"""
+import gzip
+import zlib
+from typing import Iterable, List, Mapping, Set, Tuple, Union
+
+try:
+    import brotli
+except ImportError:
+    # br is only requested from upstream when it can be decoded
+    brotli = None
+
+# headers that only apply to one connection, plus the length which is
+# recomputed for the body that is actually sent
+HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'proxy-connection',
+    'te', 'trailer', 'trailers', 'transfer-encoding', 'upgrade', 'content-length',
+}
+
+
+class ContentDecodingError(ValueError):
+    """Body cannot be decoded: unsupported or corrupt content-encoding"""
+    pass
+
+
+def _inflate(body: bytes) -> bytes:
+    # "deflate" should be zlib wrapped, some servers send raw deflate
+    try:
+        return zlib.decompress(body)
+    except zlib.error:
+        return zlib.decompress(body, -zlib.MAX_WBITS)
+
+
+DECODERS = {
+    'gzip': gzip.decompress,
+    'x-gzip': gzip.decompress,
+    'deflate': _inflate,
+}
+if brotli is not None:
+    DECODERS['br'] = brotli.decompress
+
+# what the proxy asks upstream for, it can decode all of it
+UPSTREAM_ACCEPT_ENCODING = ', '.join(encoding for encoding in ('br', 'gzip', 'deflate') if encoding in DECODERS)
+
+
+def accepted_encodings(accept_encoding: str) -> Set[str]:
+    """
+    Content codings a client accepts, from its Accept-Encoding header
+    """
+    encodings = set()
+    for item in (accept_encoding or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = params.strip().lower()
+        if quality.startswith('q=') and _quality(quality[2:]) == 0:
+            continue
+        encodings.add(coding)
+    return encodings
+
+
+def _quality(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        return 1.0
+
+
+def content_codings(encoding: str) -> List[str]:
+    """
+    Codings of a Content-Encoding header in the order they were applied
+    """
+    codings = [coding.strip().lower() for coding in (encoding or '').split(',')]
+    return [coding for coding in codings if coding and coding != 'identity']
+
+
+def is_accepted(encoding: str, accept_encoding: str) -> bool:
+    """
+    Whether a body in `encoding` can be sent as is to the client,
+    every coding of a stacked encoding must be accepted
+    """
+    accepted = accepted_encodings(accept_encoding)
+    return all(
+        coding in accepted or ('*' in accepted and coding in DECODERS) for coding in content_codings(encoding))
+
+
+def decompress(body: bytes, encoding: str) -> bytes:
+    """
+    Decode a body, the last applied coding first. Raise ContentDecodingError
+    for an unsupported encoding or a corrupt body.
+    """
+    for coding in reversed(content_codings(encoding)):
+        if coding not in DECODERS:
+            raise ContentDecodingError(f"Unsupported content-encoding {coding}")
+        try:
+            body = DECODERS[coding](body)
+        except Exception as exc:
+            raise ContentDecodingError(f"Corrupt {coding} body: {exc}") from exc
+    return body
+
+
+def forwardable_headers(headers: Union[Mapping[str, str], Iterable[Tuple[str, str]]]) -> List[Tuple[str, str]]:
+    """
+    Drop hop-by-hop headers, including those listed in Connection. Return
+    (name, value) pairs, so repeated headers such as Set-Cookie are kept.
+    """
+    items = list(headers.items() if hasattr(headers, 'items') else headers)
+    connection = {
+        token.strip().lower() for name, value in items if name.lower() == 'connection'
+        for token in value.split(',')}
+    return [
+        (name, value) for name, value in items
+        if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() not in connection]
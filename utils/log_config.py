@@ -1,30 +1,256 @@
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import weakref
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+
 from pydantic import BaseModel
 
+from config import LOG_LEVEL, LOG_FILE, LOG_FILE_MAX_BYTES, LOG_FILE_BACKUP_COUNT
+
+# id of the request being handled, attached to every log record
+request_id_var: ContextVar = ContextVar("request_id", default=None)
+
+
+class RequestIdFilter(logging.Filter):
+    """Add the current request id to log records"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "request_id", None) is None:
+            record.request_id = request_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line, with the structured extras"""
+
+    FIELDS = ("request_id", "user", "model", "path", "status", "prompt_tokens", "completion_tokens",
+              "latency_ms", "prompt")
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class AsyncBatchHandler(logging.Handler):
+    """
+    Queue records on the calling thread, format and write them in batches
+    from a background thread so logging never blocks request handling.
+    Records are dropped, and counted, when the queue is full.
+
+    The writer thread starts on the first record, in the process that logs
+    it, so handlers configured before a fork (`gunicorn --preload`) write
+    from each worker.
+    """
+
+    def __init__(self, level=logging.NOTSET, batch_size: int = 256, max_queue: int = 10000) -> None:
+        super().__init__(level)
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+        self.dropped = 0
+        self._reset()
+        _handlers.add(self)
+
+    def _reset(self) -> None:
+        """Forget the queue and writer, which belong to the parent after a fork"""
+        self.queue = queue.Queue(self.max_queue)
+        self._writer = None
+        self._pid = os.getpid()
+        self._start_lock = threading.Lock()
+
+    def _after_fork(self) -> None:
+        """Called in a forked child before it logs"""
+        self._reset()
+
+    def _start_writer(self) -> None:
+        if self._writer is not None and self._pid == os.getpid():
+            return
+        if self._pid != os.getpid():
+            # forked without the at-fork hook
+            self._after_fork()
+        with self._start_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+                self._writer.start()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        Resolve what depends on the caller: message arguments and traceback
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self._start_writer()
+            self.queue.put_nowait(self.prepare(record))
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _run(self) -> None:
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            batch = [record]
+            # take whatever else is queued, batches grow with the load
+            while len(batch) < self.batch_size:
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is None:
+                    self._write_records(batch)
+                    return
+                batch.append(record)
+            self._write_records(batch)
+
+    def _write_records(self, records: list) -> None:
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.format(record) + "\n")
+            except Exception:
+                self.handleError(record)
+        try:
+            self.write("".join(lines))
+        except Exception:
+            self.handleError(records[-1])
+
+    def write(self, data: str) -> None:
+        """Write a batch of formatted records"""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Write what is still queued, then stop the writer thread"""
+        if self._writer is not None and self._pid == os.getpid() and self._writer.is_alive():
+            self.queue.put(None)
+            self._writer.join()
+        super().close()
+
+
+# handlers to reset in forked children
+_handlers = weakref.WeakSet()
+
+
+def _after_fork_in_child() -> None:
+    for handler in list(_handlers):
+        handler._after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class AsyncStreamHandler(AsyncBatchHandler):
+    """Non-blocking version of `logging.StreamHandler`"""
+
+    def __init__(self, stream=None, **kwargs) -> None:
+        self.stream = stream or sys.stderr
+        super().__init__(**kwargs)
+
+    def write(self, data: str) -> None:
+        self.stream.write(data)
+        self.stream.flush()
+
+
+class AsyncRotatingFileHandler(AsyncBatchHandler):
+    """
+    Non-blocking version of `logging.handlers.RotatingFileHandler`.
+    Forked children write to their own `<name>.<pid><ext>` file, processes
+    rotating the same file would overwrite each other's backups.
+    """
+
+    def __init__(self, filename: str, maxBytes: int = 0, backupCount: int = 0, **kwargs) -> None:
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.filename = filename
+        self.file = RotatingFileHandler(filename, maxBytes=maxBytes, backupCount=backupCount, encoding="utf-8")
+        super().__init__(**kwargs)
+
+    def _after_fork(self) -> None:
+        super()._after_fork()
+        root, ext = os.path.splitext(self.filename)
+        inherited = self.file
+        self.file = RotatingFileHandler(
+            f"{root}.{os.getpid()}{ext}", maxBytes=inherited.maxBytes, backupCount=inherited.backupCount,
+            encoding="utf-8")
+        # the parent keeps writing to the inherited file
+        inherited.close()
+
+    def write(self, data: str) -> None:
+        file = self.file
+        if file.maxBytes > 0 and file.stream.tell() + len(data) >= file.maxBytes:
+            file.doRollover()
+        file.stream.write(data)
+        file.stream.flush()
+
+    def close(self) -> None:
+        super().close()
+        self.file.close()
+
 
 class LogConfig(BaseModel):
     """Logging configuration to be set for the server"""
 
     LOGGER_NAME: str = "openai-api"
     LOG_FORMAT: str = "%(levelprefix)s | %(asctime)s | %(message)s"
-    LOG_LEVEL: str = "DEBUG"
+    LOG_LEVEL: str = LOG_LEVEL
 
     # Logging config
     version = 1
     disable_existing_loggers = False
+    filters = {
+        "request_id": {"()": "utils.log_config.RequestIdFilter"},
+    }
     formatters = {
         "default": {
             "()": "uvicorn.logging.DefaultFormatter",
             "fmt": LOG_FORMAT,
             "datefmt": "%Y-%m-%d %H:%M:%S",
         },
+        "json": {
+            "()": "utils.log_config.JsonFormatter",
+            "datefmt": "%Y-%m-%dT%H:%M:%S%z",
+        },
     }
     handlers = {
         "default": {
+            "()": "utils.log_config.AsyncStreamHandler",
             "formatter": "default",
-            "class": "logging.StreamHandler",
             "stream": "ext://sys.stderr",
         },
+        "file": {
+            "()": "utils.log_config.AsyncRotatingFileHandler",
+            "formatter": "json",
+            "filters": ["request_id"],
+            "filename": LOG_FILE,
+            "maxBytes": LOG_FILE_MAX_BYTES,
+            "backupCount": LOG_FILE_BACKUP_COUNT,
+        },
     }
     loggers = {
-        LOGGER_NAME: {"handlers": ["default"], "level": LOG_LEVEL},
+        LOGGER_NAME: {"handlers": ["default", "file"], "level": LOG_LEVEL},
     }
@@ -1,8 +1,9 @@
 
 from typing import Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, validator
 import requests
 from config import JWT_SECRET_KEY, CHAT_MODEL
+from chatgpt.models import get_model
 
 users = [("openaiDriver", "hope&poem")]
 
@@ -50,10 +51,42 @@ class ChatRequest(BaseModel):
 
 
 class EmbeddingRequest(BaseModel):
-    text: str
+    # the embedding API rejects empty input
+    text: str = Field(..., min_length=1)
     model: Optional[str] = "text-embedding-ada-002"
+    # split long texts in chunks of chunk_size tokens
+    chunk_size: Optional[int] = Field(None, gt=0)
+    chunk_overlap: Optional[int] = Field(0, ge=0)
+    # return one token weighted mean vector instead of a vector per chunk
+    pool: Optional[bool] = False
+    # also store the vectors in this collection, chunks get "<document_id>:<n>" ids
+    collection: Optional[str] = None
+    document_id: Optional[str] = None
+    metadata: Optional[dict] = None
+
+    @validator('chunk_size')
+    def chunk_within_model_window(cls, chunk_size, values):
+        # text_embedding caps the chunks at the model context window too
+        if chunk_size and values.get('model'):
+            return min(chunk_size, get_model(values['model']).context_window)
+        return chunk_size
+
+    @validator('chunk_overlap')
+    def overlap_smaller_than_chunk(cls, chunk_overlap, values):
+        if values.get('chunk_size') and chunk_overlap >= values['chunk_size']:
+            raise ValueError("chunk_overlap must be smaller than chunk_size")
+        return chunk_overlap
 
 
 class ChatResponse(BaseModel):
     ask: str = None
     response: str = None
+
+
+class SearchRequest(BaseModel):
+    collection: str
+    query: str = Field(..., min_length=1)
+    model: Optional[str] = "text-embedding-ada-002"
+    top_k: Optional[int] = Field(10, gt=0, le=1000)
+    # only match vectors whose metadata has these values
+    filters: Optional[dict] = None